@@ -0,0 +1,115 @@
+# Compare the server-side download paths of REQ_get on loopback.
+#
+#   python benchmarks/bench_get.py --size 256 --rounds 5
+#
+# "read" is the original `dF.read() + b'\0'` path, "chunks" streams the
+# DFile through the asyncio buffers in bufsize blocks and "sendfile" hands
+# the temp file to the kernel. CPU time is measured on the server thread.
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "weily-FileTransfer"))
+
+from app.client import Client
+from app.mux import MuxStream
+from app.server import Server, DFile, checkRange
+from app.utility import stdloggers
+
+
+class ReadServer(Server):
+    async def REQ_get(self, reader, writer, type, *, file: str, passwd: str = "", offset=0, length=None, **kw):
+        # "codec" is ignored, the reply is sent uncompressed
+        dF = self.file_table[file]
+        size = dF.filesize
+        length = checkRange(offset, length, size)
+        data = dF.read()[offset : offset + length]
+        if isinstance(writer, MuxStream):
+            await writer.send_head(size=size, offset=offset, length=length)
+            await self.send(writer, data)
+        else:
+            await self.send(writer, data + b"\0")
+
+
+class ChunkServer(Server):
+    async def send_dfile(self, writer: asyncio.StreamWriter, dF: DFile, offset=0, length=None):
+        await self.send_chunks(writer, dF.chunks(self.bufsize, offset, length))
+
+
+VARIANTS = {"read": ReadServer, "chunks": ChunkServer, "sendfile": Server}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(cls, port: int):
+    app = cls("127.0.0.1", port, 60)
+    ready = threading.Event()
+    state = {}
+
+    async def main():
+        server = await asyncio.start_server(app.handle_client, "127.0.0.1", port)
+        state["loop"] = asyncio.get_running_loop()
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(main(),), daemon=True).start()
+    ready.wait()
+    return state["loop"]
+
+
+def thread_time(loop: asyncio.AbstractEventLoop):
+    async def get():
+        return time.thread_time()
+
+    return asyncio.run_coroutine_threadsafe(get(), loop).result()
+
+
+def run(variant: str, path: str, size: int, rounds: int):
+    port = free_port()
+    loop = start_server(VARIANTS[variant], port)
+    client = Client("127.0.0.1", port, client_timeout=60)
+    assert client.insert(path) == "Ok.", variant
+    name = os.path.basename(path)
+    cpu0, t0 = thread_time(loop), time.perf_counter()
+    with open(os.devnull, "wb") as null:
+        for _ in range(rounds):
+            client.get(name, output=null)
+    wall, cpu = time.perf_counter() - t0, thread_time(loop) - cpu0
+    mb = size * rounds / 2**20
+    print(f"{variant:>10} {mb / wall:10.1f} MB/s {cpu:8.3f} s cpu {cpu / mb * 1000:8.3f} ms/MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark REQ_get download paths.")
+    parser.add_argument("--size", type=int, default=256, help="file size in MiB")
+    parser.add_argument("--rounds", type=int, default=5, help="downloads per variant")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+
+    try:
+        # inside the try: --help and bad arguments exit, the logger must still close
+        args = parser.parse_args()
+        stdloggers.log_file = open(os.devnull, "w")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.bin")
+            with open(path, "wb") as f:
+                for _ in range(args.size):
+                    f.write(os.urandom(2**20))
+            for variant in args.variants:
+                run(variant, path, args.size * 2**20, args.rounds)
+    finally:
+        stdloggers.close()
+
+
+if __name__ == "__main__":
+    main()
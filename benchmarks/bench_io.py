@@ -0,0 +1,135 @@
+# Latency seen by other clients while a large upload is being written.
+#
+#   python benchmarks/bench_io.py --size 64 --disk 20
+#
+# The disk is slowed down to --disk MB/s by sleeping in DFile.write_at.
+# "inline" runs every disk call on the event loop like the server used to,
+# "executor" is the current server with its I/O threads and write-behind.
+# A second client times "list" and a small "get" during the upload.
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "weily-FileTransfer"))
+
+from app.client import Client
+from app.server import Server, DFile
+from app.utility import stdloggers
+
+
+class InlineServer(Server):
+    def run_io(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            future.set_result(func(*args))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+
+VARIANTS = {"inline": InlineServer, "executor": Server}
+
+
+def slow_disk(mbps: float):
+    write_at = DFile.write_at
+
+    def throttled(self, data, offset):
+        time.sleep(len(data) / (mbps * 2**20))
+        write_at(self, data, offset)
+
+    DFile.write_at = throttled
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(cls, port: int):
+    app = cls("127.0.0.1", port, 60)
+    ready = threading.Event()
+
+    async def main():
+        server = await asyncio.start_server(app.handle_client, "127.0.0.1", port)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(main(),), daemon=True).start()
+    ready.wait()
+
+
+def percentile(samples, q: float):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def run(variant: str, path: str, small: str):
+    port = free_port()
+    start_server(VARIANTS[variant], port)
+    uploader = Client("127.0.0.1", port, client_timeout=60)
+    other = Client("127.0.0.1", port, client_timeout=60)
+    assert other.insert(small) == "Ok.", variant
+    done = threading.Event()
+
+    def upload():
+        assert uploader.insert(path) == "Ok.", variant
+        done.set()
+
+    threading.Thread(target=upload, daemon=True).start()
+    samples = {"list": [], "get": []}
+    t0 = time.perf_counter()
+    while not done.is_set():
+        t = time.perf_counter()
+        other.list()
+        samples["list"].append(time.perf_counter() - t)
+        t = time.perf_counter()
+        other.get(os.path.basename(small))
+        samples["get"].append(time.perf_counter() - t)
+    wall = time.perf_counter() - t0
+    for name, data in samples.items():
+        print(
+            f"{variant:>10} {name:>5} n={len(data):<5} "
+            f"p50 {statistics.median(data) * 1000:8.2f} ms "
+            f"p99 {percentile(data, 0.99) * 1000:8.2f} ms "
+            f"max {max(data) * 1000:8.2f} ms  (upload {wall:.2f} s)"
+        )
+    uploader.close()
+    other.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark request latency during a large upload.")
+    parser.add_argument("--size", type=int, default=64, help="upload size in MiB")
+    parser.add_argument("--disk", type=float, default=20, help="simulated disk speed in MiB/s")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+
+    try:
+        # inside the try: --help and bad arguments exit, the logger must still close
+        args = parser.parse_args()
+        stdloggers.log_file = open(os.devnull, "w")
+        slow_disk(args.disk)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "upload.bin")
+            small = os.path.join(tmp, "small.txt")
+            with open(path, "wb") as f:
+                for _ in range(args.size):
+                    f.write(os.urandom(2**20))
+            with open(small, "wb") as f:
+                f.write(os.urandom(4096))
+            for variant in args.variants:
+                run(variant, path, small)
+    finally:
+        stdloggers.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,467 @@
+# Reproducible benchmark suite for the client/server transfer paths.
+#
+#   python benchmarks/suite.py --server subprocess --output before.json
+#   python benchmarks/suite.py --server subprocess --compare before.json
+#
+# Starts a Server on loopback, in this process or as a child process, and
+# drives Clients through the scenarios below. Every scenario reports MB/s,
+# p50/p99 latency of its operations, CPU seconds of the client and server
+# side and the peak RSS of the server. Results are saved as JSON together
+# with the commit, so runs can be compared across commits with --compare.
+#
+#   large     one --size MiB upload and --rounds downloads
+#   small     --files uploads and downloads of --small KiB files
+#   clients   --clients Clients downloading --client-size MiB at once
+#   list      full, delta and paged listings of a --entries file table
+#   slow      upload, download and list through a throttling proxy that
+#             limits the link to --link-rate MiB/s and --link-delay ms
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "weily-FileTransfer"))
+
+from app.client import Client
+from app.server import Server
+from app.utility import stdloggers
+
+SCENARIOS = ("large", "small", "clients", "list", "slow")
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, q: float):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def write_random(path: str, size: int):
+    with open(path, "wb") as f:
+        while size > 0:
+            f.write(os.urandom(min(size, 2**20)))
+            size -= 2**20
+
+
+async def serve(app: Server, port: int, ready):
+    server = await asyncio.start_server(app.handle_client, "127.0.0.1", port)
+    ready()
+    async with server:
+        await server.serve_forever()
+
+
+class InProcess:
+    """Server on a thread of this process; CPU is the thread time of the loop.
+
+    Its peak RSS can't be told apart from the clients', so it is left out."""
+
+    def __init__(self, bufsize: Optional[int]):
+        self.port = free_port()
+        ready = threading.Event()
+        app = Server("127.0.0.1", self.port, 60, bufsize=bufsize)
+        state = {}
+
+        def started():
+            state["loop"] = asyncio.get_running_loop()
+            ready.set()
+
+        threading.Thread(
+            target=asyncio.run, args=(serve(app, self.port, started),), daemon=True
+        ).start()
+        ready.wait()
+        self.loop: asyncio.AbstractEventLoop = state["loop"]
+
+    def cpu(self):
+        async def get():
+            return time.thread_time()
+
+        return asyncio.run_coroutine_threadsafe(get(), self.loop).result()
+
+    def reset_peak(self):
+        pass
+
+    def peak_rss(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class SubProcess:
+    """Server in a child process; CPU and RSS are read from /proc."""
+
+    def __init__(self, bufsize: Optional[int]):
+        self.port = free_port()
+        command = [sys.executable, os.path.abspath(__file__), "--serve", str(self.port)]
+        if bufsize is not None:
+            command += ["--bufsize", str(bufsize)]
+        self.proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+        assert self.proc.stdout is not None
+        assert self.proc.stdout.readline().strip() == b"ready", "server did not start"
+
+    def status(self, key: str):
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith(key + ":"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def cpu(self):
+        try:
+            with open(f"/proc/{self.proc.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def reset_peak(self):
+        # "5" resets the peak RSS (VmHWM) of the process on Linux
+        try:
+            with open(f"/proc/{self.proc.pid}/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+    def peak_rss(self):
+        return self.status("VmHWM")
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+class Throttle:
+    """TCP proxy that emulates a slow link in both directions.
+
+    Data is delivered `delay` seconds after it was read, at most `rate`
+    bytes per second."""
+
+    def __init__(self, target: int, rate: float, delay: float):
+        self.target = target
+        self.rate = rate
+        self.delay = delay
+        self.port = free_port()
+        ready = threading.Event()
+        threading.Thread(target=asyncio.run, args=(self.main(ready),), daemon=True).start()
+        ready.wait()
+
+    async def main(self, ready: threading.Event):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            up_reader, up_writer = await asyncio.open_connection("127.0.0.1", self.target)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(self.pipe(reader, up_writer), self.pipe(up_reader, writer))
+
+    async def pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+
+        async def deliver():
+            free = loop.time()
+            while True:
+                due, data = await queue.get()
+                if not data:
+                    break
+                free = max(free, due) + len(data) / self.rate
+                await asyncio.sleep(free - loop.time())
+                writer.write(data)
+                await writer.drain()
+
+        task = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                await queue.put((loop.time() + self.delay, data))
+                if not data:
+                    break
+            await task
+        except (OSError, asyncio.CancelledError):
+            task.cancel()
+        finally:
+            writer.close()
+
+
+class Run:
+    def __init__(self, server, args, tmp: str):
+        self.server = server
+        self.args = args
+        self.tmp = tmp
+        self.clients = []
+
+    def client(self, port=None):
+        client = Client(
+            "127.0.0.1",
+            port or self.server.port,
+            client_timeout=600,
+            bufsize=self.args.bufsize,
+            streams=self.args.streams,
+        )
+        self.clients.append(client)
+        return client
+
+    def path(self, name: str, size: int = 0):
+        path = os.path.join(self.tmp, name)
+        if not os.path.exists(path):
+            write_random(path, size)
+        return path
+
+    def measure(self, func):
+        self.server.reset_peak()
+        cpu, server_cpu = time.process_time(), self.server.cpu()
+        t0 = time.perf_counter()
+        result = func()
+        wall = time.perf_counter() - t0
+        end = self.server.cpu()
+        result.update(
+            wall=wall,
+            client_cpu=time.process_time() - cpu,
+            server_cpu=None if end is None or server_cpu is None else end - server_cpu,
+            server_peak_rss=self.server.peak_rss(),
+        )
+        return result
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+def timed(samples, func, *args, **kw):
+    t = time.perf_counter()
+    result = func(*args, **kw)
+    samples.append(time.perf_counter() - t)
+    return result
+
+
+def summary(samples, nbytes: int, wall: float):
+    return {
+        "n": len(samples),
+        "mb_s": nbytes / 2**20 / wall if wall else None,
+        "p50": percentile(samples, 0.5),
+        "p99": percentile(samples, 0.99),
+    }
+
+
+def transfer(run: Run, client: Client, path: str, rounds: int):
+    """Upload `path` once and download it `rounds` times."""
+    name, size = os.path.basename(path), os.path.getsize(path)
+    output = os.path.join(run.tmp, "out-" + name)
+    up, down = [], []
+    t0 = time.perf_counter()
+    assert timed(up, client.insert, path) == "Ok.", name
+    t1 = time.perf_counter()
+    for _ in range(rounds):
+        timed(down, client.get, name, output=output)
+    t2 = time.perf_counter()
+    assert os.path.getsize(output) == size, name
+    os.remove(output)
+    return {
+        "upload": summary(up, size, t1 - t0),
+        "download": summary(down, size * rounds, t2 - t1),
+    }
+
+
+def scenario_large(run: Run):
+    path = run.path("large.bin", run.args.size * 2**20)
+    return transfer(run, run.client(), path, run.args.rounds)
+
+
+def scenario_small(run: Run):
+    args, client = run.args, run.client()
+    paths = [run.path(f"small-{i:05}.bin", args.small * 1024) for i in range(args.files)]
+    up, down = [], []
+    t0 = time.perf_counter()
+    for path in paths:
+        assert timed(up, client.insert, path) == "Ok.", path
+    t1 = time.perf_counter()
+    with open(os.devnull, "wb") as null:
+        for path in paths:
+            timed(down, client.get, os.path.basename(path), output=null)
+    t2 = time.perf_counter()
+    nbytes = args.files * args.small * 1024
+    return {
+        "upload": summary(up, nbytes, t1 - t0),
+        "download": summary(down, nbytes, t2 - t1),
+    }
+
+
+def scenario_clients(run: Run):
+    args = run.args
+    path = run.path("shared.bin", args.client_size * 2**20)
+    assert run.client().insert(path) == "Ok.", path
+    clients = [run.client() for _ in range(args.clients)]
+    samples = []
+
+    def download(i: int):
+        output = os.path.join(run.tmp, f"client-{i}.bin")
+        for _ in range(args.rounds):
+            timed(samples, clients[i].get, "shared.bin", output=output)
+        os.remove(output)
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.clients) as pool:
+        for future in [pool.submit(download, i) for i in range(args.clients)]:
+            future.result()
+    wall = time.perf_counter() - t0
+    nbytes = args.client_size * 2**20 * args.rounds * args.clients
+    return {"download": summary(samples, nbytes, wall)}
+
+
+def scenario_list(run: Run):
+    args, client = run.args, run.client()
+    entries = os.path.join(run.tmp, "entries")
+    os.makedirs(entries, exist_ok=True)
+    paths = []
+    for i in range(args.entries):
+        paths.append(os.path.join(entries, f"entry-{i:06}.txt"))
+        open(paths[-1], "wb").close()
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        for result in pool.map(client.insert, paths):
+            assert result == "Ok.", result
+    samples = {"full": [], "delta": [], "page": []}
+    t0 = time.perf_counter()
+    for _ in range(args.rounds * 10):
+        timed(samples["full"], client.reply_json, client.requset_head(type="list"))
+        timed(samples["delta"], client.list)
+        timed(samples["page"], client.list_page, "size", reverse=True, limit=100)
+    wall = time.perf_counter() - t0
+    assert len(client.listing) >= args.entries, len(client.listing)
+    return {
+        "entries": args.entries,
+        **{kind: summary(data, 0, 0) for kind, data in samples.items()},
+        "requests_s": sum(map(len, samples.values())) / wall,
+    }
+
+
+def scenario_slow(run: Run):
+    args = run.args
+    proxy = Throttle(run.server.port, args.link_rate * 2**20, args.link_delay / 1000)
+    client = run.client(proxy.port)
+    path = run.path("slow.bin", args.slow_size * 2**20)
+    result = transfer(run, client, path, 1)
+    samples = []
+    for _ in range(args.rounds * 4):
+        timed(samples, client.list)
+    return {**result, "list": summary(samples, 0, 0)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def flatten(data, prefix=""):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(old, new):
+    old = dict(flatten(old["scenarios"]))
+    for key, value in flatten(new["scenarios"]):
+        if old.get(key):
+            change = (value - old[key]) / old[key] * 100
+            print(f"{key:<32} {old[key]:14.4f} -> {value:14.4f} {change:+8.1f}%")
+
+
+def show(name: str, result):
+    for key, value in flatten(result):
+        text = f"{value:14.4f}" if isinstance(value, float) else f"{value:14}"
+        print(f"{name + '.' + key:<32} {text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the client/server transfer paths.")
+    parser.add_argument("--server", choices=("inprocess", "subprocess"), default="inprocess")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--bufsize", type=int, default=None, help="bufsize of server and clients")
+    parser.add_argument("--streams", type=int, default=None, help="parallel connections per large file")
+    parser.add_argument("--rounds", type=int, default=3, help="repetitions of each measurement")
+    parser.add_argument("--size", type=int, default=256, help="large file size in MiB")
+    parser.add_argument("--files", type=int, default=500, help="number of small files")
+    parser.add_argument("--small", type=int, default=16, help="small file size in KiB")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--client-size", type=int, default=32, help="file size in MiB per client download")
+    parser.add_argument("--entries", type=int, default=10000, help="file table size of the list scenario")
+    parser.add_argument("--slow-size", type=int, default=8, help="file size in MiB over the slow link")
+    parser.add_argument("--link-rate", type=float, default=10, help="slow link speed in MiB/s")
+    parser.add_argument("--link-delay", type=float, default=20, help="slow link one-way delay in ms")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+
+    try:
+        # inside the try: --help and bad arguments exit, the logger must still close
+        args = parser.parse_args()
+        stdloggers.log_file = open(os.devnull, "w")
+        if args.serve is not None:
+            app = Server("127.0.0.1", args.serve, 60, bufsize=args.bufsize)
+            asyncio.run(serve(app, args.serve, lambda: print("ready", flush=True)))
+            return
+        kind = InProcess if args.server == "inprocess" else SubProcess
+        results = {
+            "commit": git_commit(),
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            # a fresh server and directory per scenario keeps them independent
+            server = kind(args.bufsize)
+            with tempfile.TemporaryDirectory() as tmp:
+                run = Run(server, args, tmp)
+                try:
+                    result = run.measure(lambda: globals()["scenario_" + name](run))
+                finally:
+                    run.close()
+                    server.close()
+            results["scenarios"][name] = result
+            show(name, result)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), results)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stdloggers.close()
+
+
+if __name__ == "__main__":
+    main()
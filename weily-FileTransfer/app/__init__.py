@@ -1,3 +1,6 @@
+from .codec import CODECS
 from .server import Server
 from .clientUI import UI
-from .utility import asyncio, stdloggers
+from .trace import profiling, tracing
+from .utility import LOG_LEVELS, LOOPS, SERVER_WORKERS, asyncio, set_loop, stdloggers
+from .workers import serve
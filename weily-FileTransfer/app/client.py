@@ -1,3 +1,6 @@
+import hashlib
+from .mux import FIN, Channel, Connection, ConnectionPool
+from .trace import tracer
 from .utility import *
 
 
@@ -9,58 +12,367 @@ class Client:
         *,
         client_timeout: Optional[float] = None,
         bufsize: Optional[int] = None,
+        pool_size: int = POOL_SIZE,
+        streams: Optional[int] = None,
+        compress: Optional[str] = None,
     ):
         self.address = (hostname, post)
         self.timeout = CLI_TIMEOUT if client_timeout is None else client_timeout
         self.bufsize = BUFSIZE if bufsize is None else bufsize
+        self.streams = STREAMS if streams is None else max(1, streams)
+        self.compress = compress
+        self.pool = ConnectionPool(
+            self.address,
+            self.timeout,
+            max(pool_size, self.streams),
+            handshake=self.handshake,
+        )
+        self.uploads: Dict[str, Tuple[str, int, float]] = {}
+        self.info: Optional[Dict[str, Any]] = None
+        # local mirror of the server's table, refreshed with deltas
+        self.listing: Dict[str, int] = {}
+        self.generation = 0
+        self.epoch: Optional[str] = None
+        self.listing_lock = threading.Lock()
+        self.watching: Optional[Tuple[threading.Event, Optional[Channel]]] = None
 
     @property
     def ver_info(self):
         return {"version": VERSION, "bufsize": self.bufsize}
 
-    def send_file(self, fd: socket.socket, filename: str):
+    def send_file(self, fd: Channel, filename: str):
         with open(filename, "rb") as f:
-            size = os.path.getsize(filename)
-            head = hex(size).encode()
-            assert len(head) <= self.bufsize, REQ_HEAD_TOO_LONG
-            safe_send_head(fd, head, self.bufsize)
-            code = fd.recv(self.bufsize)
-            assert code == OK, FAIL_REQ
+            size = os.fstat(f.fileno()).st_size
             sent = 0
             while True:
                 data = f.read(self.bufsize)
                 if not data:
                     break
-                try_send(fd, data)
+                fd.sendall(data)
                 sent += len(data)
-                code = fd.recv(self.bufsize).replace(CONT, b'')
-                assert not code, code.decode()
                 yield (sent, size)
 
-    def requset_head(self, **data: str):
-        cli = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        cli.settimeout(self.timeout)
-        cli.connect(self.address)
-        cli.sendall(json.dumps(data).encode())
-        return cli
+    def requset_head(
+        self, *, body: bool = False, conn: Optional[Connection] = None, **data: Any
+    ):
+        head, flags = json.dumps(data).encode(), 0 if body else FIN
+        if conn is not None:
+            return conn.open(head, self.timeout, flags)
+        return self.pool.open(head, flags)
+
+    def reply_json(self, cli: Channel):
+        try:
+            res = recvs(cli, self.bufsize)
+            cli.result()
+        finally:
+            cli.close()
+        try:
+            return json.loads(res.decode())
+        except (json.JSONDecodeError, UnicodeError):
+            raise AssertionError(CANT_READ)
+
+    def reply(self, cli: Channel):
+        try:
+            recvs(cli, self.bufsize)
+            cli.result()
+        except AssertionError as err:
+            return str(err)
+        finally:
+            cli.close()
+        return OK.decode()
+
+    def close(self):
+        self.unwatch()
+        self.pool.close()
+
+    def handshake(self, conn: Connection):
+        self.check_info(self.requset_head(type="test", conn=conn, **self.ver_info))
 
     def test(self):
-        cli = self.requset_head(type="test")
-        code = cli.recv(self.bufsize)
-        code = json.loads(code.decode())
-        cli.close()
-        assert code == self.ver_info, SETTING_DIFF
+        self.check_info(self.requset_head(type="test", **self.ver_info))
+
+    def check_info(self, cli: Channel):
+        try:
+            code = self.reply_json(cli)
+        except AssertionError:
+            raise AssertionError(SETTING_DIFF)
+        assert isinstance(code, dict), SETTING_DIFF
+        assert all(code.get(k) == v for k, v in self.ver_info.items()), SETTING_DIFF
+        self.info = code
+
+    def server_info(self):
+        if self.info is None:
+            self.test()
+        return self.info or {}
+
+    @property
+    def dedup(self):
+        return self.server_info().get("dedup") is True
+
+    @property
+    def codec(self):
+        if self.compress is None:
+            return None
+        codecs = self.server_info().get("codecs")
+        if isinstance(codecs, list) and self.compress in codecs:
+            return self.compress
+        return None
+
+    def codec_head(self):
+        codec = self.codec
+        return {} if codec is None else {"codec": codec}
 
     def list(self):
+        res = self.reply_json(
+            self.requset_head(type="list", since=self.generation, epoch=self.epoch)
+        )
+        return self.apply_list(res)
+
+    def list_page(
+        self,
+        sort: str = "name",
+        *,
+        reverse: bool = False,
+        prefix: str = "",
+        contains: str = "",
+        match: str = "",
+        offset: int = 0,
+        limit: Optional[int] = None,
+        cursor: Optional[List[Any]] = None,
+    ):
+        """Filtered and sorted rows `[name, size, mtime]`, paged by the server.
+
+        Pass the returned `cursor` back to get the next page. Meant for
+        scripts and clients that do not keep the table, see `watch`."""
+        res = self.reply_json(
+            self.requset_head(
+                type="list",
+                sort=sort,
+                reverse=reverse,
+                prefix=prefix,
+                contains=contains,
+                match=match,
+                offset=offset,
+                limit=limit,
+                cursor=cursor,
+            )
+        )
+        assert isinstance(res, dict) and isinstance(res.get("total"), int), CANT_READ
+        rows = res.get("files")
+        assert is_instance_of(rows, List[Tuple[str, int, Union[int, float]]]), CANT_READ
+        return res
+
+    def apply_list(self, res: Any):
+        assert isinstance(res, dict), CANT_READ
+        assert isinstance(res.get("generation"), int), CANT_READ
+        with self.listing_lock:
+            if res.get("epoch") != self.epoch or res["generation"] > self.generation:
+                if "files" in res:
+                    assert is_instance_of(res["files"], List[Tuple[str, int]]), CANT_READ
+                    self.listing = dict(res["files"])
+                else:
+                    added, removed = res.get("added"), res.get("removed")
+                    assert is_instance_of(added, List[Tuple[str, int]]), CANT_READ
+                    assert is_instance_of(removed, List[str]), CANT_READ
+                    for name in removed:
+                        self.listing.pop(name, None)
+                    self.listing.update(added)
+                self.generation, self.epoch = res["generation"], res.get("epoch")
+            return [[name, size] for name, size in self.listing.items()]
+
+    def watch(self, callback: Callable[[List[List[Any]]], Any]):
+        """Follow the server's table in the background.
+
+        `callback` gets the whole table whenever the server pushes a change."""
+        self.unwatch()
+        self.watching = (threading.Event(), None)
+        threading.Thread(
+            target=self.watch_loop, args=(self.watching[0], callback), daemon=True
+        ).start()
+
+    def unwatch(self):
+        with self.listing_lock:
+            if self.watching is None:
+                return
+            stop, cli = self.watching
+            self.watching = None
+            stop.set()
+        if cli is not None:
+            cli.close()  # resets the stream on the server
+            cli.feed_eof(reset=True)
+
+    def watch_loop(self, stop: threading.Event, callback: Callable[..., Any]):
+        while not stop.is_set():
+            try:
+                cli = self.requset_head(
+                    type="watch", since=self.generation, epoch=self.epoch
+                )
+                cli.settimeout(None)
+            except (OSError, AssertionError):
+                stop.wait(WATCH_RETRY)
+                continue
+            try:
+                with self.listing_lock:
+                    if stop.is_set():
+                        return
+                    self.watching = (stop, cli)
+                buf = b""
+                while True:
+                    data = cli.recv(self.bufsize)
+                    if not data:
+                        break
+                    *lines, buf = (buf + data).split(b"\n")
+                    for line in lines:
+                        try:
+                            res = json.loads(line.decode())
+                        except (json.JSONDecodeError, UnicodeError):
+                            raise AssertionError(CANT_READ)
+                        callback(self.apply_list(res))
+                cli.result()
+            except (OSError, AssertionError):
+                stop.wait(WATCH_RETRY)
+            finally:
+                cli.close()
+
+    def usage(self):
+        res = self.reply_json(self.requset_head(type="usage"))
+        assert is_instance_of(res, Dict[str, Union[int, float]]), CANT_READ
+        res: Dict[str, Union[int, float]]
+        return res
+
+    def stats(self):
+        res = self.reply_json(self.requset_head(type="stats"))
+        assert isinstance(res, dict) and isinstance(res.get("requests"), dict), CANT_READ
+        return res
+
+    def stat(self, file: str):
+        res = self.reply_json(self.requset_head(type="stat", file=file))
+        assert isinstance(res, dict) and isinstance(res.get("size"), int), CANT_READ
+        return res["size"]
+
+    def split(self, size: int, offset: int = 0):
+        count = max(1, min(self.streams, size // PART_MIN))
+        step = max(1, -(-size // count))
+        return [(offset + i, min(step, size - i)) for i in range(0, size, step)]
+
+    def missing(self, size: int, ranges: List[List[int]]):
+        gaps, pos = [], 0
+        for lo, hi in ranges + [[size, size]]:
+            if pos < lo:
+                gaps.extend(self.split(lo - pos, pos))
+            pos = max(pos, hi)
+        return gaps
+
+    def run_parts(
+        self,
+        worker: Callable[..., None],
+        jobs: List[Tuple[Any, ...]],
+        total: int,
+        callback: Callable[[int, int], Any] = lambda sent, size: None,
+    ):
+        """Run `jobs` in order on at most `self.streams` connections."""
+        events: queue.Queue = queue.Queue()
+        pending: Deque[Tuple[Any, ...]] = collections.deque(jobs)
+        stop = threading.Event()
+
+        def run(conn: Connection):
+            try:
+                while not stop.is_set():
+                    try:
+                        job = pending.popleft()
+                    except IndexError:
+                        break
+                    with tracer.span(worker.__name__):
+                        worker(conn, stop, events.put, *job)
+                events.put(None)
+            except (OSError, AssertionError) as err:
+                events.put(err)
+
+        workers = self.pool.spread(min(self.streams, len(jobs)))
+        for conn in workers:
+            threading.Thread(target=run, args=(conn,), daemon=True).start()
+        done, sent, error = 0, 0, None
+        while done < len(workers):
+            event = events.get()
+            if event is None or isinstance(event, BaseException):
+                done += 1
+                if event is not None and error is None and not stop.is_set():
+                    error = event
+                    stop.set()
+            else:
+                sent += event
+                if not stop.is_set() and callback(sent, total):
+                    stop.set()
+        if error is not None:
+            raise error
+        return not stop.is_set()
+
+    def put_part(
+        self,
+        conn: Connection,
+        stop: threading.Event,
+        progress: Callable[[int], None],
+        filepath: str,
+        token: str,
+        offset: int,
+        length: int,
+    ):
+        cli = self.requset_head(
+            type="put", token=token, offset=offset, length=length, body=True, conn=conn
+        )
+        cli.codec = self.codec
         try:
-            cli = self.requset_head(type="list")
-            res = json.loads(recvs(cli, self.bufsize).decode())
+            with open(filepath, "rb") as f:
+                f.seek(offset)
+                while length and not stop.is_set():
+                    data = f.read(min(self.bufsize, length))
+                    assert data, FAIL_LEN
+                    cli.sendall(data)
+                    length -= len(data)
+                    progress(len(data))
+            cli.shutdown(socket.SHUT_WR)
+        except AssertionError:
+            pass
+        finally:
+            code = self.reply(cli)
+        assert stop.is_set() or code == OK.decode(), code
+
+    def get_part(
+        self,
+        conn: Connection,
+        stop: threading.Event,
+        progress: Callable[[int], None],
+        file: str,
+        passwd: str,
+        fd: int,
+        part: List[int],
+    ):
+        offset, length = part
+        cli = self.requset_head(
+            type="get",
+            file=file,
+            passwd=passwd,
+            offset=offset,
+            length=length,
+            conn=conn,
+            **self.codec_head(),
+        )
+        try:
+            cli.head()
+            while True:
+                if stop.is_set():
+                    return
+                data = cli.recv(self.bufsize)
+                if not data:
+                    break
+                pwrite(fd, data, part[0])
+                part[0] += len(data)
+                progress(len(data))
+            cli.result()
+            # a short stream would leave a hole of zeros in the output
+            assert part[0] == offset + length, FAIL_LEN
+        finally:
             cli.close()
-            assert is_instance_of(res, List[Tuple[str, int]]), CANT_READ
-            res: List[Tuple[str, int]]
-            return res
-        except (json.JSONDecodeError, TypeError):
-            raise AssertionError(CANT_READ)
 
     def insert(
         self,
@@ -68,32 +380,198 @@ class Client:
         passwd: str = "",
         *,
         callback: Callable[[int, int], None] = lambda sent, size: None,
+        keep: bool = False,
     ):
-        self.test()
+        """Upload `filepath`; `callback` returns True to stop.
+
+        With `keep`, a stopped upload stays open on the server and the next
+        insert of the file resumes it, see `abort_upload`."""
         file = getFilename(filepath)
-        cli = self.requset_head(type="insert", file=file, passwd=passwd)
-        code = cli.recv(self.bufsize)
-        if code != OK:
-            return code.decode()
-        for p, q in self.send_file(cli, filepath):
-            if callback(p, q):
-                cli.shutdown(socket.SHUT_WR)
-                break
-        code = cli.recv(self.bufsize).replace(CONT, b'')
-        while not code:
-            code = cli.recv(self.bufsize).replace(CONT, b'')
-        return code.replace(CONT, b"").decode()
+        size = os.path.getsize(filepath)
+        if size >= PART_MIN or self.dedup:
+            return self.insert_parts(filepath, passwd, size, callback, keep)
+        cli = self.requset_head(
+            type="insert", file=file, passwd=passwd, size=size, body=True
+        )
+        cli.codec = self.codec
+        try:
+            for p, q in self.send_file(cli, filepath):
+                if callback(p, q):
+                    break
+            cli.shutdown(socket.SHUT_WR)
+        except AssertionError:
+            pass  # the server refused the upload, reply() reports why
+        finally:
+            code = self.reply(cli)
+        return code
+
+    def hash_file(self, filepath: str):
+        digests = []
+        with open(filepath, "rb") as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                digests.append(hashlib.sha256(data).digest())
+        root = hashlib.sha256(b"".join(digests)).hexdigest()
+        return root, [digest.hex() for digest in digests]
+
+    def resume(self, token: str):
+        res = self.reply_json(self.requset_head(type="resume", token=token))
+        assert isinstance(res, dict), CANT_READ
+        assert is_instance_of(res.get("ranges"), List[List[int]]), CANT_READ
+        return res["ranges"]
+
+    def open_upload(self, filepath: str, passwd: str, size: int):
+        key, mtime = os.path.abspath(filepath), os.path.getmtime(filepath)
+        if key in self.uploads:
+            token, old_size, old_mtime = self.uploads.pop(key)
+            if (old_size, old_mtime) == (size, mtime):
+                try:
+                    return token, self.resume(token)
+                except AssertionError:
+                    pass  # expired on the server, start over
+        head = {"file": getFilename(filepath), "passwd": passwd, "size": size}
+        if self.dedup:
+            head["digest"], head["chunks"] = self.hash_file(filepath)
+        res = self.reply_json(self.requset_head(type="open", **head))
+        assert isinstance(res, dict) and isinstance(res.get("token"), str), CANT_READ
+        assert is_instance_of(res.get("ranges", []), List[List[int]]), CANT_READ
+        self.uploads[key] = (res["token"], size, mtime)
+        return res["token"], res.get("ranges", [])
+
+    def insert_parts(
+        self,
+        filepath: str,
+        passwd: str,
+        size: int,
+        callback: Callable[[int, int], Any],
+        keep: bool = False,
+    ):
+        try:
+            token, ranges = self.open_upload(filepath, passwd, size)
+        except AssertionError as err:
+            return str(err)
+        parts = self.missing(size, ranges)
+        jobs = [(filepath, token, *part) for part in parts]
+        done = size - sum(length for offset, length in parts)
+
+        def progress(sent: int, size: int):
+            return callback(done + sent, size)
+
+        try:
+            if not (done and callback(done, size)) and self.run_parts(
+                self.put_part, jobs, size, progress
+            ):
+                code = self.reply(self.requset_head(type="commit", token=token))
+                if code == OK.decode():
+                    self.uploads.pop(os.path.abspath(filepath), None)
+                return code
+        except (OSError, EOFError, AssertionError) as err:
+            # Keep the token: the next insert of this file resumes the upload.
+            return str(err) or FAIL_SEND
+        if not keep:
+            self.abort_upload(filepath)
+        return ABORT
+
+    def abort_upload(self, filepath: str):
+        entry = self.uploads.pop(os.path.abspath(filepath), None)
+        if entry is not None:
+            self.reply(self.requset_head(type="abort", token=entry[0]))
 
     def erase(self, file: str, passwd: str = ""):
-        self.test()
-        cli = self.requset_head(type="erase", file=file, passwd=passwd)
-        code = cli.recv(self.bufsize)
-        cli.close()
-        return code.decode()
-
-    def get(self, file: str, passwd: str = ""):
-        self.test()
-        cli = self.requset_head(type="get", file=file, passwd=passwd)
-        res = recvs(cli, self.bufsize)
-        cli.close()
-        return res
+        return self.reply(self.requset_head(type="erase", file=file, passwd=passwd))
+
+    def iter_get(self, file: str, passwd: str = "", offset: int = 0):
+        cli = self.requset_head(
+            type="get", file=file, passwd=passwd, offset=offset, **self.codec_head()
+        )
+        try:
+            length, done = cli.head().get("length"), 0
+            while True:
+                data = cli.recv(self.bufsize)
+                if not data:
+                    break
+                done += len(data)
+                yield data
+            cli.result()
+            assert length is None or done == length, FAIL_LEN
+        finally:
+            cli.close()
+
+    def get_parts(
+        self,
+        file: str,
+        passwd: str,
+        output: str,
+        offset: int = 0,
+        callback: Callable[[int, int], Any] = lambda done, size: None,
+    ):
+        size = self.stat(file)
+        offset = offset if offset <= size else 0
+        parts = [list(part) for part in self.split(size - offset, offset)]
+        if len(parts) == 1:
+            return False
+        with open(output, "r+b" if offset else "wb") as f:
+            try:
+                f.truncate(size)
+                jobs = [(file, passwd, f.fileno(), part) for part in parts]
+                if not self.run_parts(
+                    self.get_part,
+                    jobs,
+                    size - offset,
+                    lambda sent, total: callback(offset + sent, size),
+                ):
+                    f.truncate(parts[0][0])
+            except BaseException:
+                # Only the leading part is contiguous; keep it for a resume.
+                f.truncate(parts[0][0])
+                raise
+        return True
+
+    def get(
+        self,
+        file: str,
+        passwd: str = "",
+        output: Union[None, str, typing.BinaryIO] = None,
+        *,
+        resume: bool = False,
+        callback: Callable[[int, int], Any] = lambda done, size: None,
+    ):
+        """Download `file`; `callback(done, size)` returns True to stop.
+
+        A stopped download keeps what it got, `resume` continues it."""
+        offset = 0
+        if resume and isinstance(output, str) and os.path.exists(output):
+            offset = os.path.getsize(output)
+        if isinstance(output, str) and self.streams > 1:
+            try:
+                if self.get_parts(file, passwd, output, offset, callback):
+                    return
+            except BaseException:
+                if os.path.exists(output) and not os.path.getsize(output):
+                    os.remove(output)
+                raise
+        cli = self.requset_head(
+            type="get", file=file, passwd=passwd, offset=offset, **self.codec_head()
+        )
+        with contextlib.ExitStack() as stack:
+            stack.callback(cli.close)  # resets the stream if we stop early
+            size = cli.head().get("size", 0)
+            buffer = stack.enter_context(io.BytesIO())
+            if isinstance(output, str):
+                output = stack.enter_context(open(output, "ab" if offset else "wb"))
+            sink = buffer if output is None else output
+            done = offset
+            while True:
+                data = cli.recv(self.bufsize)
+                if not data:
+                    cli.result()
+                    assert done == size, FAIL_LEN
+                    break
+                sink.write(data)
+                done += len(data)
+                if callback(done, size):
+                    break
+            if output is None:
+                return buffer.getvalue()
@@ -1,7 +1,10 @@
+import bisect
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 
 from .client import *
+from .trace import tracer
+from .transfer import CANCELLED, DONE, FAILED, Transfer, TransferQueue
 
 
 class ProgressbarToplevel(tk.Toplevel):
@@ -53,6 +56,196 @@ class ProgressbarToplevel(tk.Toplevel):
         self.update()
 
 
+class TransfersToplevel(ProgressbarToplevel):
+    """Progress of a batch with one row per transfer. Pause, Resume and
+    Cancel act on the selected rows, or on all of them."""
+
+    def __init__(
+        self,
+        master: tk.Misc,
+        title: str,
+        queue: TransferQueue,
+        transfers: List[Transfer],
+    ):
+        self.queue = queue
+        self.transfers = transfers
+        super().__init__(master, title, 480, 240)
+
+    def initUI(self):
+        self.progress_bar = ttk.Progressbar(
+            self, orient="horizontal", mode="determinate"
+        )
+        self.progress_bar.place(relx=0.03, rely=0.04, relwidth=0.94, relheight=0.1)
+        self.tree = ttk.Treeview(self, columns=("#1", "#2", "#3"))
+        self.tree.column("#0", width=0, stretch=tk.NO)
+        self.tree.column("#2", width=70, stretch=tk.NO)
+        self.tree.column("#3", width=140, stretch=tk.NO)
+        self.tree.heading("#1", text="File", anchor=tk.W)
+        self.tree.heading("#2", text="State", anchor=tk.W)
+        self.tree.heading("#3", text="Progress", anchor=tk.W)
+        for index, transfer in enumerate(self.transfers):
+            self.tree.insert("", tk.END, iid=str(index), values=self.values(transfer))
+        self.tree.place(relx=0.03, rely=0.18, relwidth=0.94, relheight=0.6)
+        actions = {
+            "Pause": self.queue.pause,
+            "Resume": self.queue.resume,
+            "Cancel": self.queue.cancel,
+        }
+        for index, (text, action) in enumerate(actions.items()):
+            command = lambda action=action: self.act(action)
+            ttk.Button(self, cursor="hand2", text=text, command=command).place(
+                relx=0.03 + index * 0.32, rely=0.82, relwidth=0.3, relheight=0.14
+            )
+        self.letTop()
+
+    @staticmethod
+    def values(transfer: Transfer):
+        progress = format_size(transfer.done)
+        if transfer.size:
+            progress += f" / {format_size(transfer.size)}"
+        return (transfer.name, transfer.state, progress)
+
+    def selected(self):
+        rows = self.tree.selection()
+        return [self.transfers[int(iid)] for iid in rows] if rows else self.transfers
+
+    @withThread
+    @logException(stdloggers.err_logger)
+    def act(self, action: Callable[[Transfer], Any]):
+        # a cancelled upload is aborted on the server, keep that off the Tk loop
+        for transfer in self.selected():
+            action(transfer)
+
+    @ignoreExceptions(tk.TclError)
+    def refresh(self):
+        for index, transfer in enumerate(self.transfers):
+            self.tree.item(str(index), values=self.values(transfer))
+
+
+class VirtualList(ttk.Frame):
+    """File list that only puts the rows in view into its Treeview.
+
+    Rows are keyed by file name. The whole table lives in `rows` and in
+    `order`, which is kept sorted; scrolling and sorting only touch the
+    handful of Treeview items on screen.
+
+    The table comes from the watch stream, which the client keeps whole
+    anyway to apply the deltas, so the rows in view are not fetched with
+    `Client.list_page`: that would cost a round trip per scroll for rows
+    already at hand.
+    """
+
+    def __init__(self, master: tk.Misc, on_heading: Callable[[int], Any]):
+        super().__init__(master)
+        self.lock = threading.RLock()
+        self.rows: Dict[str, int] = {}
+        self.order: List[Tuple[Any, str]] = []
+        self.sort_col, self.reverse = 0, False
+        self.top = 0
+        self.selected: Set[str] = set()
+        self.rowheight = int(ttk.Style(self).lookup("Treeview", "rowheight") or 20)
+        self.bar = ttk.Scrollbar(self, command=self.yview)
+        self.tree = ttk.Treeview(self, columns=("#1", "#2"), selectmode="extended")
+        self.tree.column("#0", width=0, stretch=tk.NO)
+        self.tree.heading("#1", text="File", anchor=tk.W, command=lambda: on_heading(0))
+        self.tree.heading("#2", text="Size", anchor=tk.W, command=lambda: on_heading(1))
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<Button-1>", lambda event: self.selected.clear())
+        self.tree.bind("<Control-Button-1>", lambda event: None)
+        self.tree.bind("<Shift-Button-1>", lambda event: None)
+        self.tree.bind("<MouseWheel>", lambda event: self.scroll(-event.delta // 120))
+        self.tree.bind("<Button-4>", lambda event: self.scroll(-3))
+        self.tree.bind("<Button-5>", lambda event: self.scroll(3))
+        self.tree.bind("<Configure>", lambda event: self.render())
+        self.tree.place(relx=0.0, rely=0.0, relwidth=0.98, relheight=1.0)
+        self.bar.place(relx=0.98, rely=0.0, relwidth=0.02, relheight=1.0)
+
+    def key(self, name: str):
+        return (name if self.sort_col == 0 else self.rows[name], name)
+
+    def at(self, index: int):
+        return self.order[~index if self.reverse else index][1]
+
+    def page(self):
+        # one row less for the heading
+        return max(1, self.tree.winfo_height() // self.rowheight - 1)
+
+    def set_rows(self, table: Iterable[Tuple[str, int]], force: bool = False):
+        rows = dict(table)
+        with self.lock:
+            changed = [name for name, size in rows.items() if self.rows.get(name) != size]
+            gone = [name for name in self.rows if name not in rows]
+            if not changed and not gone and not force:
+                return
+            if force or len(changed) + len(gone) > UI_RESORT:
+                self.rows = rows
+                self.order = sorted(map(self.key, rows))
+            else:
+                old = {self.key(name) for name in gone + changed if name in self.rows}
+                if old:
+                    self.order = [key for key in self.order if key not in old]
+                self.rows = rows
+                for name in changed:
+                    bisect.insort(self.order, self.key(name))
+            self.selected.intersection_update(rows)
+            self.render()
+
+    def sort(self, col: int, reverse: bool):
+        with self.lock:
+            if col != self.sort_col:
+                self.sort_col = col
+                self.order = sorted(map(self.key, self.rows))
+            self.reverse = reverse
+            self.render()
+
+    def selection(self):
+        with self.lock:
+            names = (self.at(i) for i in range(len(self.order)))
+            return [name for name in names if name in self.selected]
+
+    def on_select(self, event: Any = None):
+        with self.lock:
+            self.selected.difference_update(self.tree.get_children())
+            self.selected.update(self.tree.selection())
+
+    def scroll(self, rows: int):
+        with self.lock:
+            self.top += rows
+            self.render()
+        return "break"
+
+    def yview(self, *args: str):
+        with self.lock:
+            if args[0] == "moveto":
+                self.top = int(float(args[1]) * len(self.order))
+            elif args[0] == "scroll":
+                self.top += int(args[1]) * (self.page() if args[2] == "pages" else 1)
+            self.render()
+
+    def render(self):
+        with self.lock:
+            total, height = len(self.order), self.page()
+            self.top = max(0, min(self.top, total - height))
+            names = [self.at(i) for i in range(self.top, min(total, self.top + height))]
+            shown = set(names)
+            stale = [item for item in self.tree.get_children() if item not in shown]
+            if stale:
+                self.tree.delete(*stale)
+            for index, name in enumerate(names):
+                values = (name, format_size(self.rows[name]))
+                if self.tree.exists(name):
+                    self.tree.item(name, values=values)
+                    self.tree.move(name, "", index)
+                else:
+                    self.tree.insert("", index, iid=name, values=values)
+            self.tree.selection_set([name for name in names if name in self.selected])
+            self.tree.yview_moveto(0)
+            if total:
+                self.bar.set(self.top / total, (self.top + len(names)) / total)
+            else:
+                self.bar.set(0, 1)
+
+
 class UI(tk.Tk):
     data: List[Tuple[str, int]]
     button_list: List[ttk.Button]
@@ -69,12 +262,17 @@ class UI(tk.Tk):
         post: int = 8080,
         client_timeout: Optional[float] = None,
         bufsize: Optional[int] = None,
+        streams: Optional[int] = None,
+        compress: Optional[str] = None,
+        workers: Optional[int] = None,
     ):
         super().__init__()
         self.timeout = client_timeout
         self.title(title)
         self.geometry(f"{width}x{height}")
         self.bufsize = bufsize
+        self.streams = streams
+        self.compress = compress
         self.data = []
         self.button_list = []
         self.sort_methed = None
@@ -84,16 +282,26 @@ class UI(tk.Tk):
         self.post = tk.StringVar(self, str(post))
         self.ignoreInfo = tk.IntVar(self, 0)
         self.ignoreWarn = tk.IntVar(self, 0)
-        self.client_socket = self.newClient()
         self.initUI()
+        self.client_socket = self.newClient()
+        self.transfers = TransferQueue(self.client_socket, workers)
 
     def newClient(self):
-        return Client(
+        client = Client(
             self.host.get(),
             int(self.post.get()),
             client_timeout=self.timeout,
             bufsize=self.bufsize,
+            streams=self.streams,
+            compress=self.compress,
         )
+        client.watch(self.watchList)
+        return client
+
+    @logException(stdloggers.err_logger)
+    def watchList(self, table: List[Tuple[str, int]]):
+        self.data = table
+        self.set_data(self.get_list(False))
 
     def initUI(self):
         self.initListboxWithBar().place(
@@ -105,24 +313,8 @@ class UI(tk.Tk):
         self.initBindKey()
 
     def initListboxWithBar(self):
-        BARWID = 0.02
-        BOXWID = 1 - BARWID
-        root = ttk.Frame(self)
-        ytableScrollbar = ttk.Scrollbar(root)
-        self.tree_lock = threading.Lock()
-        self.tree = ttk.Treeview(root, yscrollcommand=ytableScrollbar.set)
-        self.tree["columns"] = ("#1", "#2")
-        self.tree.column("#0", width=0, stretch=tk.NO)
-        self.tree.heading(
-            "#1", text="File", anchor=tk.W, command=lambda: self.sel_head(0)
-        )
-        self.tree.heading(
-            "#2", text="Size", anchor=tk.W, command=lambda: self.sel_head(1)
-        )
-        ytableScrollbar.config(command=self.tree.yview)
-        self.tree.place(relx=0.0, rely=0.0, relwidth=BOXWID, relheight=1.0)
-        ytableScrollbar.place(relx=BOXWID, rely=0.0, relwidth=BARWID, relheight=1.0)
-        return root
+        self.listview = VirtualList(self, self.sel_head)
+        return self.listview
 
     def initButtons(self):
         DX, DY = 0.02, 0.05
@@ -187,41 +379,18 @@ class UI(tk.Tk):
             self.sort_methed = (col, False)
         else:
             self.sort_methed = (col, not self.sort_methed[1])
-        self.set_data(self.get_list(False), True)
+        self.listview.sort(*self.sort_methed)
 
     def get_list(self, force: bool = True):
         if force:
             self.data = self.client_socket.list()
-        if self.sort_methed is not None:
-            i, r = self.sort_methed
-            self.data.sort(key=lambda tp: tp[i], reverse=r)
         return self.data
 
     def getSelFile(self):
-        sel = self.tree.selection()
-        return [str(self.tree.item(it, "values")[0]) for it in sel]
+        return self.listview.selection()
 
     def set_data(self, table: List[Tuple[str, int]], force: bool = False):
-        with self.tree_lock:
-            if force:
-                for item in self.tree.get_children():
-                    self.tree.delete(item)
-                for file, size in table:
-                    self.tree.insert("", tk.END, values=(file, format_size(size)))
-            else:
-                new_data = map(lambda tp: (tp[0], format_size(tp[1])), table)
-                current_items = list(self.tree.get_children())
-                current_data = {
-                    tuple(self.tree.item(it)["values"]): it for it in current_items
-                }
-                for new_it in new_data:
-                    if new_it in current_data:
-                        item_id = current_data[new_it]
-                        current_items.remove(item_id)
-                    else:
-                        self.tree.insert("", tk.END, values=new_it)
-                for it in current_items:
-                    self.tree.delete(it)
+        self.listview.set_rows(table, force)
 
     def _updateList(self):
         self.set_data(self.get_list())
@@ -231,7 +400,9 @@ class UI(tk.Tk):
     def testCon(self):
         try:
             self.block_button(UI_BLOCK)
+            self.client_socket.close()
             self.client_socket = self.newClient()
+            self.transfers.client = self.client_socket
             self.client_socket.test()
             self._updateList()
             self.showinfo("Link Ok.")
@@ -272,88 +443,78 @@ class UI(tk.Tk):
             self.block_button(UI_BLOCK)
             self.client_socket.test()
             passwd = self.token.get()
-            for filename in filedialog.askopenfilenames(title=self.title()):
-                self.pushFile(filename, passwd)
+            files = filedialog.askopenfilenames(title=self.title())
+            if files:
+                self.runTransfers(
+                    "Uploading", [self.transfers.put(fn, passwd) for fn in files]
+                )
+                self._updateList()
         except (OSError, AssertionError) as err:
             self.showwarning(str(err))
 
-    @withThread
-    @logException(stdloggers.err_logger)
-    def pushFile(self, fn: str, passwd: str):
-        @ignoreExceptions(tk.TclError, True)
-        def pushCallBack(sent: int, size: int):
-            if not size or not pro.winfo_exists():
-                self.close_toplever(pro)
-                return True
-            pro.run(sent, size)
-            self.update()
-            return False
-
+    def runTransfers(self, title: str, transfers: List[Transfer]):
+        """Show the progress of a batch until it is over; closing the window cancels it."""
+        toplevel = self.start_toplever(title, transfers)
         try:
-            pro = self.start_toplever(f"Uploading - {getFilename(fn)}")
-            self.showinfo_fromServer(
-                self.client_socket.insert(fn, passwd, callback=pushCallBack),
-                getFilename(fn),
-            )
-            self._updateList()
-        except (OSError, AssertionError) as err:
-            self.showwarning(str(err), getFilename(fn))
-        except UnicodeError:
-            self.showwarning(FAIL_SEND, getFilename(fn))
+            while not self.transfers.wait(transfers, UI_POLL):
+                if not toplevel.winfo_exists():
+                    for transfer in transfers:
+                        self.transfers.cancel(transfer)
+                    continue
+                with tracer.span("progress"):
+                    self.showProgress(toplevel, title, transfers)
         finally:
-            pushCallBack(0, 0)
-
-    def downloadFile(
-        self,
-        filename: str,
-        passwd: str,
-        output: Optional[str] = None,
-        *,
-        toplevel: Optional[ProgressbarToplevel] = None,
+            self.close_toplever(toplevel)
+        ok = [transfer for transfer in transfers if transfer.state == DONE]
+        for transfer in transfers:
+            if transfer.state == FAILED:
+                self.showwarning(transfer.result or FAIL_REQ, transfer.name)
+        if any(transfer.state == CANCELLED for transfer in transfers):
+            self.showinfo(ABORT)
+        if ok:
+            self.showinfo(f"{len(ok)}/{len(transfers)} {OK.decode()}")
+
+    def showProgress(
+        self, toplevel: TransfersToplevel, title: str, transfers: List[Transfer]
     ):
-        needClose = toplevel is None
-        if toplevel is not None:
-            toplevel.title(f"Download - {filename}")
+        finished = sum(not transfer.active for transfer in transfers)
+        total = sum(transfer.size for transfer in transfers)
+        done = sum(
+            transfer.done if transfer.active else transfer.size
+            for transfer in transfers
+        )
+        rate = self.transfers.throughput()
+        eta = format_time((total - done) / rate) if rate else "--:--:--"
+        toplevel.title(
+            f"{title} {finished}/{len(transfers)}"
+            f" - {format_size(rate)}/s, ETA {eta}"
+        )
+        toplevel.refresh()
+        if total:
+            toplevel.run(done, total)
         else:
-            toplevel = self.start_toplever(f"Download - {filename}")
-            toplevel.start()
-        self.update()
-        try:
-            ret = self.client_socket.get(filename, passwd)
-            if not toplevel.winfo_exists():
-                self.showinfo("Abort.", filename)
-                return True
-            elif not ret[-1]:
-                ret.pop()
-                fn = (
-                    self.asksaveasfilename(initialfile=filename)
-                    if not output
-                    else output
-                )
-                if not fn:
-                    return
-                with open(fn, "wb") as f:
-                    f.write(ret)
-                self.showinfo("Install Ok.", filename)
-            else:
-                self.showinfo_fromServer(ret.decode(), filename)
-        finally:
-            if needClose:
-                self.close_toplever(toplevel)
+            toplevel.run(finished, len(transfers))
+
+    def downloadFile(self, filename: str, passwd: str):
+        fn = self.asksaveasfilename(initialfile=filename)
+        if fn:
+            size = self.listview.rows.get(filename, 0)
+            self.runTransfers(
+                f"Download - {filename}",
+                [self.transfers.get(filename, passwd, fn, size)],
+            )
 
     def downloadFiles(self, filelist: List[str], passwd: str):
-        toplevel = self.start_toplever(f"Download")
-        toplevel.start()
-        self.update()
-        try:
-            outdir = self.askdirectory()
-            if not outdir:
-                return
-            for fn in filelist:
-                if self.downloadFile(fn, passwd, outdir + "/" + fn, toplevel=toplevel):
-                    return
-        finally:
-            self.close_toplever(toplevel)
+        outdir = self.askdirectory()
+        if outdir:
+            sizes = self.listview.rows
+            self.runTransfers(
+                "Download",
+                [
+                    self.transfers.get(fn, passwd, outdir + "/" + fn, sizes.get(fn, 0))
+                    for fn in filelist
+                ],
+            )
 
     @withThread
     def download(self):
@@ -373,8 +534,14 @@ class UI(tk.Tk):
             except AssertionError as err:
                 self.showwarning(str(err))
 
-    def start_toplever(self, title: Optional[str] = None):
-        tl = ProgressbarToplevel(self, self.title() if title is None else title)
+    def start_toplever(
+        self, title: Optional[str] = None, transfers: Optional[List[Transfer]] = None
+    ):
+        title = self.title() if title is None else title
+        if transfers is None:
+            tl = ProgressbarToplevel(self, title)
+        else:
+            tl = TransfersToplevel(self, title, self.transfers, transfers)
         self.toplever_table.add(tl)
         return tl
 
@@ -0,0 +1,83 @@
+import bz2
+import lzma
+import math
+import zlib
+import tempfile
+from .utility import *
+
+
+# frame flags naming the codec of a compressed DATA frame
+ZLIB = 0x02
+LZMA = 0x04
+BZ2 = 0x08
+COMPRESSED = ZLIB | LZMA | BZ2
+
+CODECS: Dict[str, Tuple[int, Callable[[bytes], bytes], Callable[[], Any]]] = {
+    "zlib": (ZLIB, lambda data: zlib.compress(data, 1), zlib.decompressobj),
+    "lzma": (LZMA, lambda data: lzma.compress(data, preset=0), lzma.LZMADecompressor),
+    "bz2": (BZ2, lambda data: bz2.compress(data, 1), bz2.BZ2Decompressor),
+}
+FLAGS = {flag: name for name, (flag, _, _) in CODECS.items()}
+
+
+def entropy(data: bytes):
+    """Bits per byte of an evenly spread sample of `data`."""
+    sample = data[:: max(1, len(data) // ENTROPY_SAMPLE)]
+    total = len(sample)
+    return -sum(
+        n / total * math.log2(n / total) for n in collections.Counter(sample).values()
+    )
+
+
+def compress(codec: Optional[str], data: bytes):
+    """Return `(flags, payload)`; incompressible data is sent as is."""
+    if codec is None or not data or entropy(data) > ENTROPY_MAX:
+        return 0, data
+    flag, encode, _ = CODECS[codec]
+    payload = encode(data)
+    if len(payload) >= len(data):
+        return 0, data
+    return flag, payload
+
+
+def decompress(flags: int, payload: bytes):
+    flags &= COMPRESSED
+    if not flags:
+        return payload
+    assert flags in FLAGS, CANT_READ
+    decoder = CODECS[FLAGS[flags]][2]()
+    try:
+        data = decoder.decompress(payload, MUX_MAX_FRAME)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError):
+        raise AssertionError(CANT_READ)
+    assert decoder.eof, CANT_READ
+    return data
+
+
+class CompressedCache:
+    """Compressed COMPRESS_BLOCK blocks of one DFile for one codec."""
+
+    def __init__(self):
+        self.temp = tempfile.TemporaryFile()
+        self.blocks: Dict[int, Tuple[int, int, int]] = {}
+        self.end = 0
+        self.lock = threading.Lock()  # filled from the I/O threads
+
+    def get(self, index: int):
+        if index not in self.blocks:
+            return None
+        flags, pos, size = self.blocks[index]
+        return flags, pread(self.temp.fileno(), size, pos) if flags else b""
+
+    def put(self, index: int, flags: int, payload: bytes):
+        if not flags:
+            self.blocks[index] = (0, 0, 0)  # kept raw, read it from the file
+            return
+        with self.lock:
+            pos, self.end = self.end, self.end + len(payload)
+        pwrite(self.temp.fileno(), payload, pos)
+        self.blocks[index] = (flags, pos, len(payload))
+
+    def close(self):
+        self.temp.close()
+        self.blocks.clear()
@@ -0,0 +1,161 @@
+import bisect
+from .utility import *
+
+
+# upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram:
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def snapshot(self):
+        return {
+            "buckets": [[bound, count] for bound, count in self.cumulative()][:-1],
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class RequestStats:
+    """Counters of one request type."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors: Dict[str, int] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ttfb = Histogram()
+        self.duration = Histogram()
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "errors": dict(self.errors),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ttfb": self.ttfb.snapshot(),
+            "duration": self.duration.snapshot(),
+        }
+
+
+class Metrics:
+    """Request metrics of a Server, allocated up front for every type.
+
+    Requests of unknown types are counted under "unknown", errors other
+    than the STATUS messages under "other", so the labels stay bounded.
+    """
+
+    def __init__(self, types: Iterable[str]):
+        self.started = time.time()
+        self.connections = 0
+        self.active = 0
+        self.requests = {name: RequestStats() for name in (*types, "unknown")}
+
+    def request(self, type: Any):
+        return self.requests.get(type) or self.requests["unknown"]
+
+    def begin(self):
+        self.active += 1
+        return self.requests["unknown"], time.monotonic()
+
+    def finish(
+        self,
+        stats: RequestStats,
+        started: float,
+        error: Optional[str] = None,
+        stream: Any = None,
+    ):
+        now = time.monotonic()
+        self.active -= 1
+        stats.count += 1
+        stats.duration.observe(now - started)
+        if error is not None:
+            error = error if error in STATUS else "other"
+            stats.errors[error] = stats.errors.get(error, 0) + 1
+        if stream is not None:
+            stats.bytes_in += stream.bytes_in
+            stats.bytes_out += stream.bytes_out
+            if stream.first is not None:
+                stats.ttfb.observe(stream.first - started)
+
+    def snapshot(self, gauges: Dict[str, Any]):
+        return {
+            "uptime": time.time() - self.started,
+            "connections": self.connections,
+            "requests_active": self.active,
+            **gauges,
+            "requests": {
+                name: stats.snapshot()
+                for name, stats in self.requests.items()
+                if stats.count
+            },
+        }
+
+    def prometheus(self, gauges: Dict[str, Union[int, float]]):
+        """Text exposition format of the metrics."""
+        lines = [
+            "# TYPE filetransfer_uptime_seconds gauge",
+            f"filetransfer_uptime_seconds {time.time() - self.started:.3f}",
+            "# TYPE filetransfer_connections gauge",
+            f"filetransfer_connections {self.connections}",
+            "# TYPE filetransfer_requests_active gauge",
+            f"filetransfer_requests_active {self.active}",
+        ]
+        for name, value in gauges.items():
+            lines.append(f"# TYPE filetransfer_{name} gauge")
+            lines.append(f"filetransfer_{name} {value}")
+        counters = (
+            ("requests_total", "count"),
+            ("bytes_in_total", "bytes_in"),
+            ("bytes_out_total", "bytes_out"),
+        )
+        for metric, attr in counters:
+            lines.append(f"# TYPE filetransfer_{metric} counter")
+            for name, stats in self.requests.items():
+                lines.append(f'filetransfer_{metric}{{type="{name}"}} {getattr(stats, attr)}')
+        lines.append("# TYPE filetransfer_errors_total counter")
+        for name, stats in self.requests.items():
+            for message, count in stats.errors.items():
+                message = message.replace("\\", "\\\\").replace('"', '\\"')
+                message = message.replace("\n", "\\n")
+                lines.append(
+                    f'filetransfer_errors_total{{type="{name}",message="{message}"}} {count}'
+                )
+        for metric, attr in (("ttfb_seconds", "ttfb"), ("duration_seconds", "duration")):
+            lines.append(f"# TYPE filetransfer_{metric} histogram")
+            for name, stats in self.requests.items():
+                hist: Histogram = getattr(stats, attr)
+                for bound, count in hist.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f'filetransfer_{metric}_bucket{{type="{name}",le="{le}"}} {count}'
+                    )
+                lines.append(f'filetransfer_{metric}_sum{{type="{name}"}} {hist.sum}')
+                lines.append(f'filetransfer_{metric}_count{{type="{name}"}} {hist.count}')
+        return "\n".join(lines) + "\n"
+
+
+def dump(path: str, text: str):
+    temp = path + ".tmp"
+    with open(temp, "w") as f:
+        f.write(text)
+    os.replace(temp, path)
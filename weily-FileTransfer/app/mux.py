@@ -0,0 +1,579 @@
+from .codec import compress, decompress
+from .trace import tracer
+from .utility import *
+
+
+# kind, flags, status, stream id, payload length
+FRAME = struct.Struct("!BBHII")
+CREDIT = struct.Struct("!I")
+
+HEAD = 1
+DATA = 2
+WINDOW = 3
+ERROR = 4
+RESET = 5
+
+FIN = 0x01
+
+
+class MuxStream:
+    """One request of a multiplexed connection on the server side.
+
+    It is handed to the `REQ_*` handlers as both the reader and the writer,
+    so they run unchanged on top of it.
+    """
+
+    def __init__(self, conn: "MuxConnection", sid: int):
+        self.conn = conn
+        self.sid = sid
+        # DATA payloads with their flags, inflated only as they are read
+        self.chunks: Deque[Tuple[int, bytes]] = collections.deque()
+        self.wire: Deque[int] = collections.deque()
+        self.pending: Deque[memoryview] = collections.deque()
+        self.consumed = 0
+        self.credit = MUX_WINDOW
+        self.window = MUX_WINDOW  # what the peer may still send
+        self.body = True
+        self.eof = False
+        self.reset = False
+        self.closed = False
+        self.finished = False
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        # for the metrics: wire bytes and time to the first reply frame
+        self.started = time.monotonic()
+        self.first: Optional[float] = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def feed(self, payload: bytes, flags: int = 0):
+        """Queue a DATA frame, False if the peer should not have sent it."""
+        # Credit is counted in wire bytes, whatever the frame inflates to.
+        self.window -= len(payload)
+        self.bytes_in += len(payload)
+        if payload and (not self.body or self.eof or self.window < 0):
+            return False
+        self.chunks.append((flags, payload))
+        self.wire.append(len(payload))
+        self.readable.set()
+        return True
+
+    def feed_eof(self):
+        self.eof = True
+        self.readable.set()
+
+    def add_credit(self, size: int):
+        self.credit += size
+        self.writable.set()
+
+    def abort(self):
+        self.reset = True
+        self.chunks.clear()
+        self.wire.clear()
+        self.feed_eof()
+        self.writable.set()
+
+    async def refuse_body(self):
+        """For requests without a body: reset the stream on any DATA."""
+        self.body = False
+        if any(self.wire):
+            await self.conn.reset(self)
+
+    async def wait_reset(self):
+        while not self.reset:
+            self.readable.clear()
+            await self.readable.wait()
+
+    def get_extra_info(self, name: str, default: Any = None):
+        return self.conn.writer.get_extra_info(name, default)
+
+    async def read(self, n: int = -1):
+        while not self.chunks and not self.eof:
+            self.readable.clear()
+            await self.readable.wait()
+        if not self.chunks:
+            return b""
+        flags, data = self.chunks.popleft()
+        self.consumed += self.wire.popleft()
+        data = decompress(flags, data)
+        if 0 <= n < len(data):
+            self.chunks.appendleft((0, data[n:]))
+            self.wire.appendleft(0)
+            data = data[:n]
+        if self.consumed >= MUX_WINDOW // 2 and not self.reset:
+            size, self.consumed = self.consumed, 0
+            self.window += size
+            await self.conn.send_frame(self.sid, WINDOW, CREDIT.pack(size))
+        return data
+
+    async def wait_credit(self):
+        if self.credit <= 0 and not self.reset:
+            # the peer has not acknowledged a window yet
+            with tracer.span("credit"):
+                while self.credit <= 0 and not self.reset:
+                    self.writable.clear()
+                    await self.writable.wait()
+        if self.reset:
+            raise ConnectionResetError(CONN_CLOSED)
+
+    def write(self, data: bytes):
+        if data:
+            self.pending.append(memoryview(bytes(data)))
+
+    async def drain(self):
+        while self.pending:
+            await self.wait_credit()
+            data = self.pending.popleft()
+            size = min(len(data), self.credit, BUFSIZE)
+            if size < len(data):
+                self.pending.appendleft(data[size:])
+            self.credit -= size
+            await self.conn.send_frame(self.sid, DATA, data[:size])
+            self.mark(size)
+
+    async def send_data(self, payload: bytes, flags: int = 0):
+        """Send `payload` as a single frame, e.g. an already compressed block."""
+        await self.drain()
+        await self.wait_credit()
+        self.credit -= len(payload)
+        await self.conn.send_frame(self.sid, DATA, payload, flags=flags)
+        self.mark(len(payload))
+
+    async def send_head(self, **meta: Any):
+        await self.conn.send_frame(self.sid, HEAD, json.dumps(meta).encode())
+        self.mark()
+
+    async def fail(self, message: str):
+        self.pending.clear()
+        if not self.finished and not self.reset:
+            self.finished = True
+            await self.conn.send_frame(
+                self.sid, ERROR, message.encode(), status=status_code(message)
+            )
+            self.mark()
+
+    async def sendfile(
+        self, file: typing.BinaryIO, offset: int = 0, count: Optional[int] = None
+    ):
+        """Send with os.sendfile, return how much was sent before it failed."""
+        await self.drain()
+        # a frame can't be cut short, so never announce more than the file has
+        available = max(0, os.fstat(file.fileno()).st_size - offset)
+        count = available if count is None else min(count, available)
+        sent = 0
+        while sent < count and self.conn.sendfile:
+            await self.wait_credit()
+            size = min(count - sent, self.credit)
+            self.credit -= size
+            await self.conn.send_file_frame(self.sid, file, offset + sent, size)
+            self.mark(size)
+            sent += size
+        return sent
+
+    def mark(self, size: int = 0):
+        if self.first is None:
+            self.first = time.monotonic()
+        self.bytes_out += size
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        try:
+            await self.drain()
+            if not self.finished and not self.reset:
+                self.finished = True
+                await self.conn.send_frame(self.sid, DATA, flags=FIN)
+                self.mark()
+        except ConnectionError:
+            pass
+        finally:
+            self.conn.streams.pop(self.sid, None)
+
+
+class MuxConnection:
+    """Server side of a persistent connection carrying many requests."""
+
+    def __init__(
+        self,
+        handler: Callable[[MuxStream, MuxStream, bytes], Awaitable[None]],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        self.handler = handler
+        self.reader = reader
+        self.writer = writer
+        self.streams: Dict[int, MuxStream] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.lock = asyncio.Lock()
+        self.sendfile = True
+
+    async def send_frame(
+        self,
+        sid: int,
+        kind: int,
+        payload: bytes = b"",
+        *,
+        flags: int = 0,
+        status: int = 0,
+    ):
+        async with self.lock:
+            self.writer.write(FRAME.pack(kind, flags, status, sid, len(payload)))
+            if payload:
+                self.writer.write(payload)
+            await self.writer.drain()
+
+    async def send_file_frame(
+        self, sid: int, file: typing.BinaryIO, offset: int, size: int
+    ):
+        async with self.lock:
+            self.writer.write(FRAME.pack(DATA, 0, 0, sid, size))
+            if self.sendfile:
+                try:
+                    loop = asyncio.get_running_loop()
+                    sent = await loop.sendfile(
+                        self.writer.transport, file, offset, size, fallback=False
+                    )
+                    if sent < size:
+                        self.broken()
+                    return
+                except (asyncio.SendfileNotAvailableError, NotImplementedError):
+                    self.sendfile = False
+            end = offset + size
+            while offset < end:
+                data = pread(file.fileno(), min(end - offset, BUFSIZE), offset)
+                if not data:
+                    self.broken()
+                offset += len(data)
+                self.writer.write(data)
+                await self.writer.drain()
+
+    def broken(self):
+        """The file shrank in the middle of a frame, the framing is lost."""
+        self.writer.transport.abort()
+        raise ConnectionResetError(CONN_CLOSED)
+
+    async def reset(self, stream: MuxStream):
+        """Drop a stream whose peer broke the protocol, e.g. overran its window."""
+        if not stream.reset:
+            stream.abort()
+            stream.finished = True
+            await self.send_frame(stream.sid, RESET)
+
+    async def read_frame(self):
+        timeout = None if self.streams else MUX_IDLE
+        head = await asyncio.wait_for(self.reader.readexactly(FRAME.size), timeout)
+        kind, flags, status, sid, length = FRAME.unpack(head)
+        assert length <= MUX_MAX_FRAME, REQ_HEAD_TOO_LONG
+        return kind, flags, sid, await self.reader.readexactly(length)
+
+    async def serve(self):
+        try:
+            while True:
+                kind, flags, sid, payload = await self.read_frame()
+                stream = self.streams.get(sid)
+                if kind == HEAD and stream is None:
+                    stream = self.streams[sid] = MuxStream(self, sid)
+                    task = asyncio.ensure_future(self.handler(stream, stream, payload))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                elif stream is None or stream.reset:
+                    continue
+                elif kind == DATA and not stream.feed(payload, flags):
+                    await self.reset(stream)
+                    continue
+                elif kind == WINDOW:
+                    stream.add_credit(CREDIT.unpack(payload)[0])
+                elif kind == RESET:
+                    stream.abort()
+                if flags & FIN:
+                    stream.feed_eof()
+        except (
+            AssertionError,
+            ConnectionError,
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+        ):
+            pass
+        finally:
+            for stream in list(self.streams.values()):
+                stream.abort()
+            if self.tasks:
+                await asyncio.wait(list(self.tasks))
+
+
+class Channel:
+    """Socket-like view of one request on a client `Connection`."""
+
+    def __init__(self, conn: "Connection", sid: int, timeout: Optional[float]):
+        self.conn = conn
+        self.sid = sid
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.chunks: Deque[memoryview] = collections.deque()
+        self.wire: Deque[int] = collections.deque()
+        self.consumed = 0
+        self.credit = MUX_WINDOW
+        self.codec: Optional[str] = None
+        self.eof = False
+        self.reset = False
+        self.shut = False
+        self.meta: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.status = 0
+
+    def settimeout(self, timeout: Optional[float]):
+        self.timeout = timeout
+
+    def feed(self, payload: bytearray, flags: int = 0):
+        data = decompress(flags, payload)
+        with self.cond:
+            self.chunks.append(memoryview(data))
+            self.wire.append(len(payload))
+            self.cond.notify_all()
+
+    def feed_eof(self, reset: bool = False):
+        with self.cond:
+            self.eof = True
+            self.reset = self.reset or reset
+            self.cond.notify_all()
+
+    def feed_head(self, meta: Dict[str, Any]):
+        with self.cond:
+            self.meta = meta
+            self.cond.notify_all()
+
+    def feed_error(self, status: int, message: str):
+        with self.cond:
+            self.status = status
+            self.error = status_text(status, message)
+            self.cond.notify_all()
+        self.feed_eof()
+
+    def add_credit(self, size: int):
+        with self.cond:
+            self.credit += size
+            self.cond.notify_all()
+
+    def wait(self, predicate: Callable[[], Any]):
+        if not self.cond.wait_for(predicate, self.timeout):
+            raise socket.timeout(TIMED_OUT)
+
+    def head(self):
+        with self.cond:
+            self.wait(lambda: self.meta is not None or self.eof)
+            assert self.error is None, self.error
+            return self.meta or {}
+
+    def result(self):
+        with self.cond:
+            self.wait(lambda: self.eof)
+            assert self.error is None, self.error
+            assert not self.reset, CONN_CLOSED
+
+    def recv(self, bufsize: int):
+        with self.cond:
+            self.wait(lambda: self.chunks or self.eof)
+            if not self.chunks:
+                return b""
+            view = self.chunks.popleft()
+            self.consumed += self.wire.popleft()
+            if len(view) > bufsize:
+                self.chunks.appendleft(view[bufsize:])
+                self.wire.appendleft(0)
+                view = view[:bufsize]
+            data = bytes(view)
+            credit = 0
+            if self.consumed >= MUX_WINDOW // 2:
+                credit, self.consumed = self.consumed, 0
+        if credit and not self.eof:
+            self.conn.send_frame(self.sid, WINDOW, CREDIT.pack(credit))
+        return data
+
+    def sendall(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            with self.cond:
+                self.wait(lambda: self.credit > 0 or self.eof)
+                assert self.error is None, self.error
+                if self.eof:
+                    raise ConnectionResetError(CONN_CLOSED)
+                if self.codec is None:
+                    size = min(len(view), self.credit, BUFSIZE)
+                else:
+                    size = min(len(view), COMPRESS_BLOCK)
+            flags, payload = compress(self.codec, view[:size])
+            with self.cond:
+                # the server resets a stream that overruns its window
+                self.wait(lambda: self.credit >= len(payload) or self.eof)
+                assert self.error is None, self.error
+                if self.eof:
+                    raise ConnectionResetError(CONN_CLOSED)
+                self.credit -= len(payload)
+            self.conn.send_frame(self.sid, DATA, payload, flags=flags)
+            view = view[size:]
+
+    def shutdown(self, how: int):
+        if not self.shut:
+            self.shut = True
+            self.conn.send_frame(self.sid, DATA, flags=FIN)
+
+    def close(self):
+        if not self.eof:
+            try:
+                self.conn.send_frame(self.sid, RESET)
+            except OSError:
+                pass
+        self.conn.release(self.sid)
+
+
+class Connection:
+    """Client side of a persistent multiplexed connection."""
+
+    def __init__(self, address: Tuple[str, int], timeout: Optional[float]):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(MUX_MAGIC)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.channels: Dict[int, Channel] = {}
+        self.next_id = 0
+        self.alive = True
+        self.last_used = time.monotonic()
+        threading.Thread(target=self.read_task, daemon=True).start()
+
+    @property
+    def load(self):
+        return len(self.channels)
+
+    def idle(self):
+        return not self.channels and time.monotonic() - self.last_used > MUX_IDLE / 2
+
+    def send_frame(
+        self, sid: int, kind: int, payload: bytes = b"", *, flags: int = 0
+    ):
+        head = FRAME.pack(kind, flags, 0, sid, len(payload))
+        with self.send_lock:
+            if len(payload) < 4096:
+                self.sock.sendall(head + payload)
+            else:
+                self.sock.sendall(head)
+                self.sock.sendall(payload)
+
+    def open(self, head: bytes, timeout: Optional[float], flags: int = FIN):
+        with self.lock:
+            assert self.alive, CONN_CLOSED
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            channel = self.channels[self.next_id] = Channel(self, self.next_id, timeout)
+            self.last_used = time.monotonic()
+        self.send_frame(channel.sid, HEAD, head, flags=flags)
+        return channel
+
+    def release(self, sid: int):
+        with self.lock:
+            self.channels.pop(sid, None)
+            self.last_used = time.monotonic()
+
+    def read_task(self):
+        try:
+            while True:
+                head = recv_exact(self.sock, FRAME.size)
+                kind, flags, status, sid, length = FRAME.unpack(head)
+                payload = recv_exact(self.sock, length)
+                channel = self.channels.get(sid)
+                if channel is None:
+                    continue
+                elif kind == DATA:
+                    channel.feed(payload, flags)
+                elif kind == HEAD:
+                    channel.feed_head(json.loads(payload.decode()))
+                elif kind == WINDOW:
+                    channel.add_credit(CREDIT.unpack(payload)[0])
+                elif kind == ERROR:
+                    channel.feed_error(status, payload.decode())
+                elif kind == RESET:
+                    channel.feed_eof(True)
+                if flags & FIN:
+                    channel.feed_eof()
+        except (OSError, EOFError, ValueError, AssertionError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            self.alive = False
+            channels = list(self.channels.values())
+        for channel in channels:
+            channel.feed_eof(True)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        timeout: Optional[float],
+        size: int = POOL_SIZE,
+        *,
+        handshake: Callable[[Connection], None] = lambda conn: None,
+    ):
+        self.address = address
+        self.timeout = timeout
+        self.size = max(1, size)
+        self.handshake = handshake
+        self.lock = threading.Lock()
+        self.conns: List[Connection] = []
+
+    def connect(self):
+        conn = Connection(self.address, self.timeout)
+        try:
+            self.handshake(conn)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def prune(self):
+        for conn in self.conns:
+            if not conn.alive or conn.idle():
+                conn.close()
+        self.conns = [conn for conn in self.conns if conn.alive]
+
+    def add(self):
+        conn = self.connect()
+        with self.lock:
+            self.conns.append(conn)
+        return conn
+
+    def pick(self):
+        with self.lock:
+            self.prune()
+            if self.conns:
+                conn = min(self.conns, key=lambda conn: conn.load)
+                if not conn.load or len(self.conns) >= self.size:
+                    return conn
+        return self.add()
+
+    def spread(self, count: int):
+        with self.lock:
+            self.prune()
+            conns = sorted(self.conns, key=lambda conn: conn.load)[:count]
+        while len(conns) < count:
+            conns.append(self.add())
+        return conns
+
+    def open(self, head: bytes, flags: int = FIN):
+        return self.pick().open(head, self.timeout, flags)
+
+    def close(self):
+        with self.lock:
+            conns, self.conns = self.conns, []
+        for conn in conns:
+            conn.close()
@@ -0,0 +1,140 @@
+from .utility import *
+
+try:
+    import fcntl
+except ImportError:  # Windows, which has no server workers either
+    fcntl = None
+
+
+MANIFEST = "manifest.json"
+JOURNAL = "journal.log"
+FILES = "files"
+PACK = "chunks.pack"
+LOCK = "manifest.lock"
+
+
+def fsync_dir(path: str):
+    if not hasattr(os, "O_DIRECTORY"):
+        return  # Windows can't open directories, replace() is enough there
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Manifest:
+    """Index of the files kept in a data directory.
+
+    The manifest is only ever replaced atomically. With `journal` set,
+    inserts and erases are appended to a journal instead and folded into
+    the manifest every JOURNAL_MAX records.
+
+    A `shared` manifest is written by several server processes: every
+    write takes a file lock and starts from what is on disk, and a name
+    that another process inserted meanwhile is refused.
+    """
+
+    def __init__(self, root: str, journal: bool = False):
+        self.root = root
+        self.journal = journal
+        self.shared = False
+        self.files = os.path.join(root, FILES)
+        self.pack = os.path.join(root, PACK)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.records = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.files, exist_ok=True)
+
+    def path(self, name: str):
+        return os.path.join(self.root, name)
+
+    def new_path(self):
+        return os.path.join(self.files, secrets.token_hex(16))
+
+    def load(self):
+        self.read()
+        self.compact()
+        self.clean()
+        return self.entries
+
+    def read(self):
+        try:
+            with open(self.path(MANIFEST), "r") as f:
+                self.entries = json.load(f)["files"]
+        except FileNotFoundError:
+            self.entries = {}
+        self.records = 0
+        try:
+            with open(self.path(JOURNAL), "r") as f:
+                for line in f:
+                    try:
+                        self.replay(json.loads(line))
+                    except ValueError:
+                        break  # torn write of the last record
+                    self.records += 1
+        except FileNotFoundError:
+            pass
+        return self.entries
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            if not self.shared:
+                yield
+                return
+            with open(self.path(LOCK), "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    self.read()
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def replay(self, record: Dict[str, Any]):
+        if record["op"] == "insert":
+            self.entries[record["name"]] = record["entry"]
+        elif record["op"] == "erase":
+            self.entries.pop(record["name"], None)
+
+    def clean(self):
+        used = {entry["file"] for entry in self.entries.values() if "file" in entry}
+        for name in os.listdir(self.files):
+            if name not in used:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.files, name))
+
+    def insert(self, name: str, entry: Dict[str, Any]):
+        if "file" in entry:
+            fsync_dir(self.files)  # the new file's name must outlive a crash too
+        with self.locked():
+            assert not self.shared or name not in self.entries, FILE_EXIST
+            self.entries[name] = entry
+            self.record({"op": "insert", "name": name, "entry": entry})
+
+    def erase(self, name: str):
+        with self.locked():
+            self.entries.pop(name, None)
+            self.record({"op": "erase", "name": name})
+
+    def record(self, record: Dict[str, Any]):
+        if not self.journal or self.records >= JOURNAL_MAX:
+            return self.compact()
+        with open(self.path(JOURNAL), "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.records += 1
+
+    def compact(self):
+        temp = self.path(MANIFEST + ".tmp")
+        with open(temp, "w") as f:
+            json.dump({"version": 1, "files": self.entries}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path(MANIFEST))
+        fsync_dir(self.root)
+        if os.path.exists(self.path(JOURNAL)):
+            with open(self.path(JOURNAL), "w") as f:
+                os.fsync(f.fileno())
+        self.records = 0
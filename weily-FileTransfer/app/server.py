@@ -1,5 +1,16 @@
+import mmap
+import bisect
+import fnmatch
+import itertools
 import hashlib
 import tempfile
+import concurrent.futures
+from .codec import CODECS, CompressedCache, compress
+from .metrics import Metrics, dump
+from .mux import MuxConnection, MuxStream
+from .persist import Manifest
+from .store import ChunkStore
+from .trace import tracer
 from .utility import *
 
 
@@ -7,12 +18,85 @@ def checkHash(passwd: bytes, hash: bytes):
     return hashlib.sha256(passwd).digest() == hash
 
 
+def checkRange(offset: Any, length: Any, size: int) -> int:
+    assert isinstance(offset, int) and 0 <= offset <= size, BAD_RANGE
+    if length is None:
+        return size - offset
+    assert isinstance(length, int) and 0 <= length <= size - offset, BAD_RANGE
+    return length
+
+
+def take_segments(
+    segments: Deque[Tuple[typing.BinaryIO, int, int]], count: int, read: bool = True
+):
+    """Consume the next `count` bytes of `segments`, return them if `read`."""
+    parts: List[bytes] = []
+    while count and segments:
+        f, pos, size = segments.popleft()
+        n = min(size, count)
+        if n < size:
+            segments.appendleft((f, pos + n, size - n))
+        if read:
+            parts.extend(pread_chunks(f.fileno(), pos, n, n))
+        count -= n
+    return b"".join(parts)
+
+
+def compress_block(
+    segments: Deque[Tuple[typing.BinaryIO, int, int]],
+    count: int,
+    codec: str,
+    cache: Optional[CompressedCache],
+    index: int,
+):
+    """The next block of `segments` as `(flags, payload)`, from `cache` if it has it."""
+    entry = None if cache is None else cache.get(index)
+    if entry is not None and entry[0]:
+        take_segments(segments, count, read=False)
+        return entry
+    data = take_segments(segments, count)
+    assert len(data) == count, FAIL_LEN
+    if entry is None:
+        entry = compress(codec, data)
+        if cache is not None:
+            cache.put(index, *entry)
+    return entry if entry[0] else (0, data)
+
+
 class DFile:
     super_passwd = b""
 
-    def __init__(self, passwd: bytes = b""):
-        self.temp = tempfile.TemporaryFile()
+    def __init__(
+        self,
+        passwd: bytes = b"",
+        path: Optional[str] = None,
+        *,
+        entry: Optional[Dict[str, Any]] = None,
+    ):
+        self.path = path
+        self.temp: Optional[typing.BinaryIO] = None
         self.passwd = hashlib.sha256(passwd).digest()
+        self.store: Optional[ChunkStore] = None
+        self.blocks: List[int] = []
+        # chunk index -> (sha256 of the chunk so far, bytes hashed), see hash_at
+        self.hashes: Dict[int, Tuple[Any, int]] = {}
+        self.size = 0
+        self.digest = ""
+        self.created = 0.0
+        self.uploader = ""
+        self.caches: Dict[str, CompressedCache] = {}
+        self.mapping: Optional[mmap.mmap] = None
+        self.readers = 0
+        if entry is not None:
+            # Loaded from a data directory, the file is opened on demand.
+            self.passwd = bytes.fromhex(entry["passwd"])
+            self.size, self.digest = entry["size"], entry["digest"]
+            self.created = entry.get("created", 0.0)
+            self.uploader = entry.get("uploader", "")
+        elif path is None:
+            self.temp = tempfile.TemporaryFile()
+        else:
+            self.temp = open(path, "w+b")
 
     @staticmethod
     def set_super_passwd(passwd: bytes):
@@ -20,17 +104,15 @@ class DFile:
 
     @property
     def filesize(self):
-        if self.temp is None:
-            return 0
-        self.temp.flush()
-        return os.fstat(self.temp.fileno()).st_size
+        # Tracked by truncate() and grow(), never asks the disk.
+        return self.size
 
     @property
     def no_passwd(self):
         return checkHash(b"", self.passwd)
 
     def closed(self):
-        return self.temp is None
+        return self.temp is None and self.store is None and self.path is None
 
     def check(self, passwd: bytes = b""):
         return (
@@ -39,20 +121,224 @@ class DFile:
             or checkHash(passwd, DFile.super_passwd)
         )
 
-    def close(self):
-        if self.temp is None:
-            return
+    def close(self, unlink: bool = True):
+        if not self.readers:
+            self.unmap()
+        for cache in self.caches.values():
+            cache.close()
+        self.caches.clear()
+        self.hashes.clear()
+        if self.store is not None:
+            self.store.release(self.blocks)
+            self.store, self.blocks = None, []
+        self.size = 0
+        if self.temp is not None:
+            self.temp.close()
+            self.temp = None
+        if self.path is not None:
+            if unlink:
+                with contextlib.suppress(OSError):
+                    os.remove(self.path)
+            self.path = None
+
+    def seal(
+        self,
+        store: Optional[ChunkStore] = None,
+        known: Optional[Dict[int, int]] = None,
+        digests: Optional[List[bytes]] = None,
+    ):
+        """Make the finished upload durable and read-only."""
+        assert self.temp is not None, FILE_NOT_EXIST
+        fd = self.temp.fileno()
+        if store is None:
+            digests = self.digests(fd)
+            if self.path is not None:
+                os.fsync(fd)
+        else:
+            self.blocks = store.store(fd, self.size, known, digests)
+            self.store = store
+            store.sync()
+            digests = [store.digests[slot] for slot in self.blocks]
+        self.digest = ChunkStore.root(digests).hex()
+        if store is None and self.path is None:
+            return  # kept in memory only
         self.temp.close()
         self.temp = None
+        if store is not None and self.path is not None:
+            os.remove(self.path)  # the data lives in the pack now
+            self.path = None
 
-    def read(self):
+    def hash_at(self, data: bytes, offset: int):
+        """Hash the CHUNK_SIZE chunks of an upload as their data arrives.
+
+        A chunk that is not written from its start in order is dropped and
+        read back by `digests` instead."""
+        view = memoryview(data)
+        while view:
+            index, start = divmod(offset, CHUNK_SIZE)
+            count = min(len(view), CHUNK_SIZE - start)
+            if start == 0:
+                self.hashes[index] = (hashlib.sha256(), 0)
+            hasher, end = self.hashes.pop(index, (None, 0))
+            if hasher is not None and start == end:
+                hasher.update(view[:count])
+                self.hashes[index] = (hasher, end + count)
+            view, offset = view[count:], offset + count
+
+    def digests(self, fd: int):
+        digests = []
+        for index in range(-(-self.size // CHUNK_SIZE)):
+            offset = index * CHUNK_SIZE
+            length = min(CHUNK_SIZE, self.size - offset)
+            hasher, end = self.hashes.get(index, (None, 0))
+            if hasher is None or end != length:
+                hasher = hashlib.sha256()
+                for data in pread_chunks(fd, offset, length, BUFSIZE):
+                    hasher.update(data)
+            digests.append(hasher.digest())
+        self.hashes.clear()
+        return digests
+
+    def load(self, store: ChunkStore, entry: Dict[str, Any]):
+        digests = [bytes.fromhex(chunk) for chunk in entry["chunks"]]
+        store.restore(entry["blocks"], digests, self.size)
+        self.store, self.blocks = store, entry["blocks"]
+
+    @property
+    def entry(self):
+        entry = {"size": self.size, "passwd": self.passwd.hex(), "digest": self.digest}
+        entry.update(self.meta)
+        if self.store is not None:
+            entry["blocks"] = self.blocks
+            entry["chunks"] = [self.store.digests[slot].hex() for slot in self.blocks]
+        elif self.path is not None:
+            entry["file"] = os.path.basename(self.path)
+        return entry
+
+    @property
+    def meta(self):
+        return {"created": self.created, "uploader": self.uploader}
+
+    def reader(self):
         if self.temp is None:
-            return b""
+            assert self.path is not None, FILE_NOT_EXIST
+            return open(self.path, "rb")
         self.temp.flush()
-        new_fd = os.dup(self.temp.fileno())
-        with os.fdopen(new_fd, "rb") as f:
-            f.seek(0)
-            return self.temp.read()
+        return os.fdopen(os.dup(self.temp.fileno()), "rb")
+
+    def truncate(self, size: int):
+        assert self.temp is not None, FILE_NOT_EXIST
+        os.ftruncate(self.temp.fileno(), size)
+        self.size = size
+
+    def grow(self, end: int):
+        self.size = max(self.size, end)
+
+    def write_at(self, data: bytes, offset: int):
+        assert self.temp is not None, FILE_NOT_EXIST
+        pwrite(self.temp.fileno(), data, offset)
+
+    def cache(self, codec: str):
+        if codec not in self.caches:
+            self.caches[codec] = CompressedCache()
+        return self.caches[codec]
+
+    @contextlib.contextmanager
+    def segments(self, offset: int = 0, length: Optional[int] = None):
+        if length is None:
+            length = self.filesize - offset
+        if self.store is None:
+            with self.reader() as f:
+                yield [(f, offset, length)]
+            return
+        store, blocks = self.store, self.blocks
+        store.acquire(blocks)  # keep the chunks alive if the file is erased
+        try:
+            yield list(store.segments(blocks, offset, length))
+        finally:
+            store.release(blocks)
+
+    @contextlib.contextmanager
+    def view(self):
+        """Read-only mapping of the file, shared by all concurrent readers."""
+        if self.mapping is None:
+            size = self.filesize
+            if not size:
+                yield memoryview(b"")
+                return
+            with self.reader() as f:
+                self.mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        mapping = self.mapping
+        self.readers += 1
+        try:
+            yield memoryview(mapping)
+        finally:
+            self.readers -= 1
+            if not self.readers and mapping is self.mapping:
+                self.unmap()
+
+    def unmap(self):
+        mapping, self.mapping = self.mapping, None
+        if mapping is not None:
+            # Slices still queued in a transport keep it mapped until freed.
+            with contextlib.suppress(BufferError):
+                mapping.close()
+
+    def chunks(self, bufsize: int, offset: int = 0, length: Optional[int] = None):
+        if self.closed():
+            return
+        if self.store is None:
+            with self.view() as view:
+                end = len(view) if length is None else offset + length
+                for pos in range(offset, end, bufsize):
+                    yield view[pos : min(pos + bufsize, end)]
+            return
+        with self.segments(offset, length) as segments:
+            for f, pos, count in segments:
+                yield from pread_chunks(f.fileno(), pos, count, bufsize)
+
+    def read(self):
+        return b"".join(self.chunks(BUFSIZE))
+
+
+class Upload:
+    def __init__(self, name: str, file: DFile, size: int):
+        self.name = name
+        self.file = file
+        self.size = size
+        self.ranges: List[List[int]] = []
+        self.known: Dict[int, int] = {}
+        self.digests: Optional[List[bytes]] = None
+        self.touch()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def add(self, start: int, end: int):
+        ranges = []
+        for lo, hi in self.ranges:
+            if hi < start or end < lo:
+                ranges.append([lo, hi])
+            else:
+                start, end = min(lo, start), max(hi, end)
+        ranges.append([start, end])
+        self.ranges = sorted(ranges)
+
+    @property
+    def offset(self):
+        return self.ranges[0][1] if self.ranges and self.ranges[0][0] == 0 else 0
+
+    @property
+    def complete(self):
+        return self.size == 0 or self.ranges == [[0, self.size]]
+
+
+# sort keys of the listing, each with an index kept sorted by Server
+SORT_KEYS: Dict[str, Callable[[str, DFile], Any]] = {
+    "name": lambda name, dF: name,
+    "size": lambda name, dF: dF.filesize,
+    "mtime": lambda name, dF: dF.created,
+}
 
 
 class Server:
@@ -66,18 +352,92 @@ class Server:
         *,
         super_passwd: Optional[str] = None,
         bufsize: Optional[int] = None,
+        grace: Optional[float] = None,
+        dedup: bool = False,
+        datadir: Optional[str] = None,
+        journal: bool = False,
+        metrics: Optional[str] = None,
     ):
         self.file_table = {}
         self.file_pre = set()
+        self.uploads: Dict[str, Upload] = {}
+        self.list_cache: Optional[bytes] = None
+        # (generation, name, size or None once erased), newest last
+        self.changes: Deque[Tuple[int, str, Optional[int]]] = collections.deque(
+            maxlen=CHANGES_MAX
+        )
+        self.generation = 0
+        self.epoch = secrets.token_hex(8)
+        self.watchers: Set["asyncio.Queue[Any]"] = set()
         self.addr = (hostname, post)
         self.timeout = client_timeout if client_timeout is not None else SER_TIMEOUT
         self.bufsize = BUFSIZE if bufsize is None else bufsize
+        self.grace = UPLOAD_GRACE if grace is None else grace
+        self.metrics = Metrics(
+            name[4:] for name in dir(type(self)) if name.startswith("REQ_")
+        )
+        self.metrics_target = metrics
+        self.io = concurrent.futures.ThreadPoolExecutor(
+            IO_WORKERS, thread_name_prefix="FileTransfer-io"
+        )
+        self.store = ChunkStore() if dedup else None
+        self.manifest = None
+        # set in the processes of `workers.serve`, changes go through the hub
+        self.worker: Optional[int] = None
+        self.hub: Optional[asyncio.StreamWriter] = None
+        if datadir is not None:
+            self.load_files(Manifest(datadir, journal), dedup)
+        self.index_files()
         if super_passwd is not None:
             DFile.set_super_passwd(super_passwd.encode())
 
+    def load_files(self, manifest: Manifest, dedup: bool):
+        self.manifest = manifest
+        entries = manifest.read() if manifest.shared else manifest.load()
+        # Chunked files stay readable even if dedup was turned off since.
+        if dedup or any("blocks" in entry for entry in entries.values()):
+            self.store = ChunkStore(path=manifest.pack)
+        for name, entry in entries.items():
+            path = None
+            if "file" in entry:
+                path = os.path.join(manifest.files, entry["file"])
+            fd = DFile(path=path, entry=entry)
+            if self.store is not None and "blocks" in entry:
+                fd.load(self.store, entry)
+            self.file_table[name] = fd
+        if self.store is not None:
+            self.store.restored()
+
+    def index_files(self):
+        self.indexes = {
+            key: sorted((get(name, dF), name) for name, dF in self.file_table.items())
+            for key, get in SORT_KEYS.items()
+        }
+
+    def share(self, worker: int):
+        """Become one of several processes serving the data directory."""
+        assert self.manifest is not None
+        self.worker = worker
+        self.manifest.shared = True
+        # a restarted worker must not reuse a generation of its predecessor
+        self.epoch = secrets.token_hex(8)
+        self.file_table = {}
+        self.load_files(self.manifest, False)
+        self.index_files()
+
     @property
     def ver_info(self):
-        return {"version": VERSION, "bufsize": self.bufsize}
+        return {
+            "version": VERSION,
+            "bufsize": self.bufsize,
+            "window": ACK_WINDOW,
+            "dedup": self.store is not None,
+            "codecs": list(CODECS),
+        }
+
+    @property
+    def legacy_info(self):
+        return {"version": LEGACY_VERSION, "bufsize": self.bufsize}
 
     async def recv(self, reader: asyncio.StreamReader):
         return await asyncio.wait_for(reader.read(self.bufsize), timeout=self.timeout)
@@ -89,37 +449,383 @@ class Server:
         except (ConnectionError, BrokenPipeError) as err:
             stdloggers.err_logger(err)
 
+    async def send_ok(self, writer: asyncio.StreamWriter):
+        if not isinstance(writer, MuxStream):
+            await self.send(writer, OK)
+
+    async def send_error(self, writer: asyncio.StreamWriter, message: str):
+        if isinstance(writer, MuxStream):
+            try:
+                await writer.fail(message)
+            except ConnectionError as err:
+                stdloggers.err_logger(err)
+        else:
+            await self.send(writer, message.encode())
+
+    async def send_chunks(self, writer: asyncio.StreamWriter, chunks: Iterator[bytes]):
+        with contextlib.closing(chunks):  # type: ignore
+            for data in chunks:
+                writer.write(data)
+                await writer.drain()
+
+    async def send_dfile(
+        self,
+        writer: asyncio.StreamWriter,
+        dF: DFile,
+        offset: int = 0,
+        length: Optional[int] = None,
+    ):
+        loop = asyncio.get_running_loop()
+        with dF.segments(offset, length) as segments:
+            for f, pos, count in segments:
+                if not count:
+                    continue
+                if isinstance(writer, MuxStream):
+                    sent = await writer.sendfile(f, pos, count)
+                    pos, count = pos + sent, count - sent
+                    if not count:
+                        continue
+                else:
+                    try:
+                        await loop.sendfile(
+                            writer.transport, f, pos, count, fallback=False
+                        )
+                        continue
+                    except (asyncio.SendfileNotAvailableError, NotImplementedError):
+                        pass
+                if dF.store is None:
+                    chunks = dF.chunks(self.bufsize, pos, count)
+                else:
+                    chunks = pread_chunks(f.fileno(), pos, count, self.bufsize)
+                await self.send_chunks(writer, chunks)
+
+    async def send_compressed(
+        self, writer: MuxStream, dF: DFile, offset: int, length: int, codec: str
+    ):
+        cache, end, size = dF.cache(codec), offset + length, dF.filesize
+        # One reader for the whole request; blocks are read, compressed or
+        # taken from the cache on the I/O threads.
+        with dF.segments(offset, length) as segments:
+            pieces = collections.deque(segments)
+            while offset < end:
+                assert not dF.closed(), FILE_NOT_EXIST
+                index, start = divmod(offset, COMPRESS_BLOCK)
+                stop = min((index + 1) * COMPRESS_BLOCK, size)
+                # Only whole blocks are cached; a ragged range edge is sent ad hoc.
+                whole = start == 0 and stop <= end
+                count = min(stop, end) - offset
+                flags, payload = await self.run_io(
+                    compress_block, pieces, count, codec, cache if whole else None, index
+                )
+                await writer.send_data(payload, flags)
+                offset += count
+
+    def new_file(self, passwd: str, writer: asyncio.StreamWriter):
+        path = None if self.manifest is None else self.manifest.new_path()
+        file = DFile(passwd.encode(), path)
+        peer = writer.get_extra_info("peername")
+        file.uploader = str(peer[0]) if peer else ""
+        return file
+
+    async def seal(self, file: DFile, upload: Optional[Upload] = None):
+        known, digests = (upload.known, upload.digests) if upload else (None, None)
+        await self.run_io(file.seal, self.store, known, digests)
+
+    async def publish(self, name: str, file: DFile, upload: Optional[Upload] = None):
+        await self.seal(file, upload)
+        if upload is not None:
+            upload.known = {}  # the references belong to the file now
+        file.created = time.time()
+        if self.manifest is not None:
+            await self.run_io(self.manifest.insert, name, file.entry)
+        self.add_file(name, file)
+        self.notify({"op": "insert", "name": name, "entry": file.entry})
+
+    def add_file(self, name: str, file: DFile):
+        if name in self.file_table:
+            # replaced by another worker, the data file is not ours to remove
+            self.drop_file(name, unlink=False)
+        self.file_table[name] = file
+        for key, get in SORT_KEYS.items():
+            bisect.insort(self.indexes[key], (get(name, file), name))
+        self.changed(name, file.filesize)
+
+    def changed(self, name: str, size: Optional[int]):
+        self.generation += 1
+        self.changes.append((self.generation, name, size))
+        self.list_cache = None
+        for events in self.watchers:
+            # A watcher that fell this far behind is dropped, see REQ_watch.
+            events.put_nowait(self.changes[-1] if events.qsize() < CHANGES_MAX else None)
+
+    async def remove(self, name: str):
+        file = self.file_table[name].entry.get("file")
+        if self.manifest is not None:
+            await self.run_io(self.manifest.erase, name)
+        self.drop_file(name)
+        self.notify({"op": "erase", "name": name, "file": file})
+
+    def notify(self, record: Dict[str, Any]):
+        if self.hub is not None:
+            self.hub.write(json.dumps(record).encode() + b"\n")
+
+    async def follow(self, reader: asyncio.StreamReader):
+        """Apply the changes that the other workers send through the hub."""
+        assert self.manifest is not None
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            record = json.loads(line)
+            if record["op"] == "insert":
+                entry = record["entry"]
+                path = os.path.join(self.manifest.files, entry["file"])
+                self.add_file(record["name"], DFile(path=path, entry=entry))
+            elif record["op"] == "erase":
+                # the name may already belong to a newer insert, relayed first
+                file = self.file_table.get(record["name"])
+                if file is not None and file.entry.get("file") == record["file"]:
+                    self.drop_file(record["name"], unlink=False)
+
+    def drop_file(self, name: str, unlink: bool = True):
+        file = self.file_table.pop(name, None)
+        if file is not None:
+            for key, get in SORT_KEYS.items():
+                index = self.indexes[key]
+                i = bisect.bisect_left(index, (get(name, file), name))
+                if i < len(index) and index[i][1] == name:
+                    del index[i]
+            self.changed(name, None)
+            file.close(unlink)
+
     async def recv_file(
         self,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
-        file: typing.BinaryIO,
+        file: DFile,
+        window: int = 0,
+        size: Optional[int] = None,
+        offset: int = 0,
     ):
-        size = int(await self.recv(reader), 16)
-        await self.send(writer, OK)
-        sent = 0
-        while sent < size:
-            data = await self.recv(reader)
-            sent += len(data)
-            await self.send(writer, CONT)
-            if not data:
-                break
-            file.write(data)
-            yield sent, size
+        legacy = size is None
+        if size is None:
+            size = int(await self.recv(reader), 16)
+            await self.send(writer, OK)
+        sent = acked = buffered = written = 0
+        # Write-behind: at most WRITE_BEHIND bytes wait for the I/O threads.
+        # What is yielded is `written`, the prefix whose writes have finished.
+        pending: Deque[Tuple[asyncio.Future, int]] = collections.deque()
+        try:
+            while sent < size:
+                data = await self.recv(reader)
+                sent += len(data)
+                if legacy and not window:
+                    await self.send(writer, CONT)
+                elif legacy and sent // window > acked:
+                    await self.send(writer, CONT * (sent // window - acked))
+                    acked = sent // window
+                if not data:
+                    break
+                pos = offset + sent - len(data)
+                file.grow(pos + len(data))
+                if self.store is None:
+                    file.hash_at(data, pos)  # the store hashes its chunks itself
+                pending.append((self.run_io(file.write_at, data, pos), len(data)))
+                buffered += len(data)
+                if buffered > WRITE_BEHIND:
+                    with tracer.span("write-behind", buffered=buffered):
+                        while buffered > WRITE_BEHIND:
+                            future, n = pending.popleft()
+                            await future
+                            buffered -= n
+                            written += n
+                while pending and pending[0][0].done():
+                    future, n = pending.popleft()
+                    future.result()
+                    buffered -= n
+                    written += n
+                yield written, size
+            if pending:
+                with tracer.span("flush", buffered=buffered):
+                    while pending:
+                        future, n = pending.popleft()
+                        await future
+                        written += n
+                yield written, size
+        finally:
+            if pending:
+                await asyncio.gather(*(f for f, n in pending), return_exceptions=True)
         assert sent == size, FAIL_LEN
 
+    def run_io(self, func: Callable[..., Any], *args: Any) -> "asyncio.Future[Any]":
+        return asyncio.get_running_loop().run_in_executor(
+            self.io, tracer.wrap(func), *args
+        )
+
     async def get_list(self):
         return [(k, self.file_table[k].filesize) for k in self.file_table.copy()]
 
     async def REQ_test(
-        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, type: str
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        version: Optional[str] = None,
+        bufsize: Optional[int] = None,
     ):
-        await self.send(writer, json.dumps(self.ver_info).encode())
+        info = self.legacy_info if version is None else self.ver_info
+        await self.send(writer, json.dumps(info).encode())
+
+    def get_delta(self, changes: Iterable[Tuple[int, str, Optional[int]]]):
+        added: Dict[str, int] = {}
+        removed: Set[str] = set()
+        for _, name, size in changes:
+            if size is None:
+                added.pop(name, None)
+                removed.add(name)
+            else:
+                added[name] = size
+        return {"added": list(added.items()), "removed": sorted(removed)}
+
+    async def list_reply(self, since: Optional[int], epoch: Optional[str]):
+        if self.list_cache is None:
+            self.list_cache = json.dumps(await self.get_list()).encode()
+        if since is None:
+            return self.list_cache
+        assert isinstance(since, int), CANT_READ
+        head = {"generation": self.generation, "epoch": self.epoch}
+        behind = self.generation - since
+        if epoch == self.epoch and 0 <= behind <= len(self.changes):
+            skip = len(self.changes) - behind
+            head.update(self.get_delta(itertools.islice(self.changes, skip, None)))
+            return json.dumps(head).encode()
+        # Too far behind, or another server run: send the whole table.
+        return json.dumps(head).encode()[:-1] + b', "files": ' + self.list_cache + b"}"
+
+    def query(
+        self,
+        sort: str,
+        reverse: bool,
+        prefix: str,
+        contains: str,
+        match: str,
+        offset: int,
+        limit: Optional[int],
+        cursor: Optional[List[Any]],
+    ):
+        """One page of the table in index order, `cursor` is the last row seen."""
+        index = self.indexes[sort]
+        lo, hi = 0, len(index)
+        if prefix and sort == "name":
+            lo = bisect.bisect_left(index, (prefix,))
+            hi = bisect.bisect_left(index, (prefix + "\U0010ffff",))
+        picked = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+        after = picked
+        if cursor is not None:
+            try:
+                if reverse:
+                    pos = bisect.bisect_left(index, tuple(cursor), lo, hi)
+                    after = range(pos - 1, lo - 1, -1)
+                else:
+                    pos = bisect.bisect_right(index, tuple(cursor), lo, hi)
+                    after = range(pos, hi)
+            except TypeError:
+                raise AssertionError(CANT_READ)
+        end = None if limit is None else offset + limit
+
+        def keep(name: str):
+            return (
+                name.startswith(prefix)
+                and contains in name
+                and (not match or fnmatch.fnmatchcase(name, match))
+            )
+
+        if not contains and not match and (not prefix or sort == "name"):
+            total = len(picked)
+            rows = [index[i] for i in after[offset:end]]
+        else:
+            total = sum(keep(index[i][1]) for i in picked)
+            kept = (index[i] for i in after if keep(index[i][1]))
+            rows = list(itertools.islice(kept, offset, end))
+        files = []
+        for _, name in rows:
+            dF = self.file_table[name]
+            files.append((name, dF.filesize, dF.created))
+        more = end is not None and len(rows) == limit and rows
+        return {
+            "generation": self.generation,
+            "epoch": self.epoch,
+            "total": total,
+            "files": files,
+            "cursor": list(rows[-1]) if more else None,
+        }
 
     async def REQ_list(
-        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, type: str
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        since: Optional[int] = None,
+        epoch: Optional[str] = None,
+        sort: Optional[str] = None,
+        reverse: bool = False,
+        prefix: str = "",
+        contains: str = "",
+        match: str = "",
+        offset: int = 0,
+        limit: Optional[int] = None,
+        cursor: Optional[List[Any]] = None,
     ):
-        await self.send(writer, json.dumps(await self.get_list()).encode())
+        if sort is None:
+            return await self.send(writer, await self.list_reply(since, epoch))
+        assert sort in SORT_KEYS and isinstance(reverse, bool), CANT_READ
+        assert is_instance_of([prefix, contains, match], List[str]), CANT_READ
+        assert isinstance(offset, int) and offset >= 0, CANT_READ
+        assert limit is None or isinstance(limit, int) and limit > 0, CANT_READ
+        assert cursor is None or is_instance_of(
+            cursor, Tuple[Union[str, int, float], str]
+        ), CANT_READ
+        page = self.query(sort, reverse, prefix, contains, match, offset, limit, cursor)
+        await self.send(writer, json.dumps(page).encode())
+
+    async def REQ_watch(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        since: Optional[int] = None,
+        epoch: Optional[str] = None,
+    ):
+        """Send the list like `since` asks, then one line per batch of changes."""
+        assert isinstance(writer, MuxStream), CANT_READ
+        events: "asyncio.Queue[Any]" = asyncio.Queue()
+        reset = asyncio.ensure_future(writer.wait_reset())
+        self.watchers.add(events)
+        try:
+            writer.write(await self.list_reply(0 if since is None else since, epoch))
+            writer.write(b"\n")
+            await writer.drain()
+            while True:
+                event = asyncio.ensure_future(events.get())
+                await asyncio.wait({event, reset}, return_when=asyncio.FIRST_COMPLETED)
+                if not event.done():
+                    event.cancel()
+                    return
+                batch = [event.result()]
+                while not events.empty():
+                    batch.append(events.get_nowait())
+                if None in batch:
+                    return  # too far behind, the client asks again with since
+                head = {"generation": batch[-1][0], "epoch": self.epoch}
+                head.update(self.get_delta(batch))
+                writer.write(json.dumps(head).encode() + b"\n")
+                await writer.drain()
+        finally:
+            self.watchers.discard(events)
+            reset.cancel()
 
     async def REQ_insert(
         self,
@@ -129,19 +835,29 @@ class Server:
         *,
         file: str,
         passwd: str = "",
+        window: int = 0,
+        size: Optional[int] = None,
     ):
+        self.expire_uploads()  # a stale session must not hold on to the name
         assert file not in self.file_table and file not in self.file_pre, FILE_EXIST
+        assert isinstance(window, int) and window >= 0, CANT_READ
+        assert size is None or isinstance(size, int) and size >= 0, CANT_READ
+        fd = self.new_file(passwd, writer)
         try:
             self.file_pre.add(file)
-            fd = DFile(passwd.encode())
             addr: Tuple[str, int] = writer.get_extra_info("peername")
-            await self.send(writer, OK)
-            async for p, q in self.recv_file(reader, writer, fd.temp):  # type: ignore
-                stdloggers.log_logger(addr, f"{p}/{q}")
-            self.file_table[file] = fd
-            await self.send(writer, OK)
+            await self.send_ok(writer)
+            async for p, q in self.recv_file(reader, writer, fd, window, size):
+                stdloggers.progress_logger(writer, addr, f"{p}/{q}", final=p == q)
+            await self.publish(file, fd)
+            await self.send_ok(writer)
+        except BaseException:
+            if file not in self.file_table:
+                fd.close()
+            raise
         finally:
             self.file_pre.remove(file)
+            stdloggers.progress_end(writer)
 
     async def REQ_erase(
         self,
@@ -154,8 +870,8 @@ class Server:
     ):
         assert file in self.file_table, FILE_NOT_EXIST
         assert self.file_table[file].check(passwd.encode()), PASSWD_ERR
-        self.file_table.pop(file).close()
-        await self.send(writer, OK)
+        await self.remove(file)
+        await self.send_ok(writer)
 
     async def REQ_get(
         self,
@@ -165,45 +881,354 @@ class Server:
         *,
         file: str,
         passwd: str = "",
+        offset: int = 0,
+        length: Optional[int] = None,
+        codec: Optional[str] = None,
     ):
         assert file in self.file_table, FILE_NOT_EXIST
         dF = self.file_table[file]
         assert dF.check(passwd.encode()), PASSWD_ERR
-        await self.send(writer, dF.read() + b'\0')
+        assert codec is None or codec in CODECS, CANT_READ
+        size = dF.filesize
+        length = checkRange(offset, length, size)
+        if isinstance(writer, MuxStream):
+            await writer.send_head(size=size, offset=offset, length=length)
+            if codec is not None:
+                await self.send_compressed(writer, dF, offset, length, codec)
+            else:
+                await self.send_dfile(writer, dF, offset, length)
+        else:
+            await self.send_dfile(writer, dF, offset, length)
+            await self.send(writer, b"\0")
 
-    async def handle_client(
+    async def REQ_stat(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        file: str,
+    ):
+        assert file in self.file_table, FILE_NOT_EXIST
+        dF = self.file_table[file]
+        info = {"size": dF.filesize, "digest": dF.digest, **dF.meta}
+        await self.send(writer, json.dumps(info).encode())
+
+    def usage(self):
+        files = list(self.file_table.values())
+        logical = sum(dF.filesize for dF in files)
+        plain = sum(dF.filesize for dF in files if dF.store is None)
+        info = {"files": len(files), "logical": logical, "chunks": 0}
+        info.update({"stored": plain, "disk": plain})
+        if self.store is not None:
+            usage = self.store.usage()
+            info["chunks"] = usage["chunks"]
+            info["stored"] += usage["stored"]
+            info["disk"] += usage["disk"]
+        info["ratio"] = logical / info["stored"] if info["stored"] else 1.0
+        return info
+
+    async def REQ_usage(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, type: str
+    ):
+        await self.send(writer, json.dumps(self.usage()).encode())
+
+    def gauges(self):
+        usage = self.usage()
+        return {
+            "files": usage["files"],
+            "uploads_inflight": len(self.file_pre),  # sessions are in it too
+            "watchers": len(self.watchers),
+            "logical_bytes": usage["logical"],
+            "stored_bytes": usage["stored"],
+            "disk_bytes": usage["disk"],
+            "chunks": usage["chunks"],
+        }
+
+    async def REQ_stats(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, type: str
+    ):
+        snapshot = self.metrics.snapshot(self.gauges())
+        await self.send(writer, json.dumps(snapshot).encode())
+
+    async def serve_metrics(
         self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+            body = self.metrics.prometheus(self.gauges()).encode()
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def export_metrics(self, target: str):
+        """Serve the Prometheus text on a local port, or dump it to a file."""
+        try:
+            if target.isdigit():
+                server = await asyncio.start_server(
+                    self.serve_metrics, "127.0.0.1", int(target)
+                )
+                async with server:
+                    await server.serve_forever()
+            while True:
+                await self.run_io(dump, target, self.metrics.prometheus(self.gauges()))
+                await asyncio.sleep(METRICS_INTERVAL)
+        except OSError as err:
+            stdloggers.warn_logger("Metrics:", str(err))
+
+    def drop_upload(self, token: str):
+        self.release_upload(self.uploads.pop(token))
+
+    def release_upload(self, upload: Upload):
+        upload.file.close()
+        if self.store is not None:
+            self.store.release(list(upload.known.values()))
+        upload.known = {}
+        self.file_pre.discard(upload.name)
+
+    def expire_uploads(self):
+        now = time.monotonic()
+        for token, upload in list(self.uploads.items()):
+            if now - upload.last_used > self.grace:
+                self.drop_upload(token)
+
+    async def expire_loop(self):
+        """Drop abandoned sessions even when no open or resume comes in."""
+        while True:
+            await asyncio.sleep(min(EXPIRE_INTERVAL, max(self.grace, 1)))
+            self.expire_uploads()
+
+    async def REQ_open(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        file: str,
+        size: int,
+        passwd: str = "",
+        digest: Optional[str] = None,
+        chunks: Optional[List[str]] = None,
+    ):
+        self.expire_uploads()
+        assert file not in self.file_table and file not in self.file_pre, FILE_EXIST
+        assert isinstance(size, int) and size >= 0, CANT_READ
+        digests = None
+        if self.store is not None and chunks is not None:
+            assert is_instance_of(chunks, List[str]), CANT_READ
+            assert len(chunks) == self.store.count(size), CANT_READ
+            digests = [bytes.fromhex(chunk) for chunk in chunks]
+            assert digest == ChunkStore.root(digests).hex(), FAIL_LEN
+        fd = self.new_file(passwd, writer)
+        fd.truncate(size)
+        token = secrets.token_hex(16)
+        upload = Upload(file, fd, size)
+        if digests is not None:
+            # Chunks the store already holds never have to be uploaded.
+            upload.digests = digests
+            upload.known = self.store.lookup(digests)
+            for index in upload.known:
+                start = index * self.store.chunk_size
+                upload.add(start, min(start + self.store.chunk_size, size))
+        self.file_pre.add(file)
+        self.uploads[token] = upload
+        info = {"token": token, "ranges": upload.ranges}
+        await self.send(writer, json.dumps(info).encode())
+
+    async def REQ_put(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        token: str,
+        offset: int,
+        length: int,
+    ):
+        assert token in self.uploads, UPLOAD_NOT_EXIST
+        upload = self.uploads[token]
+        assert length is not None, BAD_RANGE
+        checkRange(offset, length, upload.size)
+        received = 0
+        try:
+            async for received, q in self.recv_file(
+                reader, writer, upload.file, size=length, offset=offset
+            ):
+                upload.touch()
+        finally:
+            # Keep whatever was written so that the client can resume the rest.
+            if received:
+                upload.add(offset, offset + received)
+        await self.send_ok(writer)
+
+    async def REQ_resume(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        token: str,
+    ):
+        self.expire_uploads()
+        assert token in self.uploads, UPLOAD_NOT_EXIST
+        upload = self.uploads[token]
+        upload.touch()
+        info = {"size": upload.size, "offset": upload.offset, "ranges": upload.ranges}
+        await self.send(writer, json.dumps(info).encode())
+
+    async def REQ_commit(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        token: str,
+    ):
+        assert token in self.uploads, UPLOAD_NOT_EXIST
+        upload = self.uploads[token]
+        assert upload.complete, FAIL_LEN
+        del self.uploads[token]
+        try:
+            await self.publish(upload.name, upload.file, upload)
+        except BaseException:
+            self.release_upload(upload)
+            raise
+        finally:
+            self.file_pre.discard(upload.name)
+        await self.send_ok(writer)
+
+    async def REQ_abort(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        type: str,
+        *,
+        token: str,
+    ):
+        assert token in self.uploads, UPLOAD_NOT_EXIST
+        self.drop_upload(token)
+        await self.send_ok(writer)
+
+    async def recv_head(self, reader: asyncio.StreamReader):
+        try:
+            head = await asyncio.wait_for(
+                reader.readexactly(len(MUX_MAGIC)), timeout=self.timeout
+            )
+        except asyncio.IncompleteReadError as err:
+            return err.partial
+        if head == MUX_MAGIC:
+            return head
+        # Old clients send a bare JSON header; read until it parses.
+        buf = bytearray(head)
+        while True:
+            try:
+                json.loads(buf)
+                return bytes(buf)
+            except ValueError:
+                assert len(buf) <= self.bufsize, REQ_HEAD_TOO_LONG
+            data = await self.recv(reader)
+            if not data:
+                return bytes(buf)
+            buf.extend(data)
+
+    async def handle_client(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        head: Optional[bytes] = None,
     ):
         addr: Tuple[str, int] = writer.get_extra_info("peername")
+        connection = head is None
+        stats, started, error = None, 0.0, None
+        self.metrics.connections += connection
         try:
-            head = json.loads(await self.recv(reader))
-            assert type(head) is dict, CANT_READ
-            assert "type" in head, CANT_READ
-            assert type(head["type"]) is str, CANT_READ
+            if head is None:
+                tracer.connect()
+                tracer.request()
+                with tracer.span("head"):
+                    head = await self.recv_head(reader)
+                if head == MUX_MAGIC:
+                    await MuxConnection(self.handle_client, reader, writer).serve()
+                    return
+            else:
+                tracer.request(writer.sid if isinstance(writer, MuxStream) else None)
+            stats, started = self.metrics.begin()
+            with tracer.span("parse", size=len(head)):
+                head = json.loads(head)
+                assert type(head) is dict, CANT_READ
+                assert "type" in head, CANT_READ
+                assert type(head["type"]) is str, CANT_READ
+            stats = self.metrics.request(head["type"])
+            if isinstance(reader, MuxStream) and head["type"] not in BODY_REQUESTS:
+                await reader.refuse_body()
             stdloggers.log_logger(addr, f"Req: {head['type']}")
-            await self.__getattribute__("REQ_" + head["type"])(reader, writer, **head)
+            with tracer.span(head["type"]):
+                await self.__getattribute__("REQ_" + head["type"])(reader, writer, **head)
         except (TypeError, AttributeError) as err:
             stdloggers.warn_logger(addr, err)
-            await self.send(writer, CANT_READ.encode())
+            error = CANT_READ
+            await self.send_error(writer, CANT_READ)
         except (TimeoutError, asyncio.exceptions.TimeoutError) as err:
             stdloggers.warn_logger(addr, TIMED_OUT)
-            await self.send(writer, TIMED_OUT.encode())
+            error = TIMED_OUT
+            await self.send_error(writer, TIMED_OUT)
         except Exception as err:
             stdloggers.warn_logger(addr, str(err))
-            await self.send(writer, str(err).encode())
+            error = str(err)
+            await self.send_error(writer, str(err))
         else:
             stdloggers.log_logger(addr, OK.decode())
         finally:
-            writer.close()
-            await writer.wait_closed()
-
-    async def start(self):
-        hostname = socket.gethostname()
-        hostip = socket.gethostbyname(hostname)
-        stdloggers.log_logger(f"Host IP: {hostip}")
-        stdloggers.log_logger(f"Host name: {hostname}")
-        server = await asyncio.start_server(self.handle_client, *self.addr)
-        stdloggers.log_logger("Start:", self.addr, self.ver_info)
+            with tracer.span("close"):
+                writer.close()
+                with contextlib.suppress(ConnectionError):
+                    await writer.wait_closed()
+            if stats is not None:
+                stream = writer if isinstance(writer, MuxStream) else None
+                self.metrics.finish(stats, started, error, stream)
+            self.metrics.connections -= connection
+
+    async def start(
+        self,
+        sock: Optional[socket.socket] = None,
+        hub: Optional[socket.socket] = None,
+    ):
+        """Serve on `self.addr`, or on the listening `sock` of a worker that
+        exchanges changes with the others over `hub`, see `workers.serve`."""
+        target = self.metrics_target
+        if sock is None:
+            hostname = socket.gethostname()
+            hostip = socket.gethostbyname(hostname)
+            stdloggers.log_logger(f"Host IP: {hostip}")
+            stdloggers.log_logger(f"Host name: {hostname}")
+            server = await asyncio.start_server(self.handle_client, *self.addr)
+        else:
+            server = await asyncio.start_server(self.handle_client, sock=sock)
+        self.expirer = asyncio.ensure_future(self.expire_loop())
+        if hub is not None:
+            reader, self.hub = await asyncio.open_connection(sock=hub)
+            self.follower = asyncio.ensure_future(self.follow(reader))
+        if self.worker is None:
+            stdloggers.log_logger("Start:", self.addr, self.ver_info)
+        else:
+            stdloggers.log_logger(f"Worker {self.worker}:", self.addr, os.getpid())
+            if target is not None and self.worker:
+                # every worker exports its own metrics
+                if target.isdigit():
+                    target = str(int(target) + self.worker)
+                else:
+                    target = f"{target}.{self.worker}"
+        if target is not None:
+            self.exporter = asyncio.ensure_future(self.export_metrics(target))
 
         async with server:
             await server.serve_forever()
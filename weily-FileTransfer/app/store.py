@@ -0,0 +1,139 @@
+import heapq
+import hashlib
+import tempfile
+from .utility import *
+
+
+class ChunkStore:
+    """Content-addressed chunks shared by every DFile of a server."""
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, path: Optional[str] = None):
+        self.chunk_size = chunk_size
+        self.path = path
+        if path is None:
+            self.pack = tempfile.TemporaryFile()
+        else:
+            self.pack = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+        self.lock = threading.Lock()
+        self.index: Dict[bytes, int] = {}
+        self.digests: Dict[int, bytes] = {}
+        self.lengths: Dict[int, int] = {}
+        self.refs: Dict[int, int] = {}
+        self.free: List[int] = []
+        self.slots = 0
+
+    def put(self, data: bytes):
+        digest = hashlib.sha256(data).digest()
+        with self.lock:
+            slot = self.index.get(digest)
+            if slot is None:
+                slot = heapq.heappop(self.free) if self.free else self.slots
+                self.slots = max(self.slots, slot + 1)
+                pwrite(self.pack.fileno(), data, slot * self.chunk_size)
+                self.index[digest] = slot
+                self.digests[slot] = digest
+                self.lengths[slot] = len(data)
+                self.refs[slot] = 0
+            self.refs[slot] += 1
+        return slot
+
+    def restore(self, blocks: List[int], digests: List[bytes], size: int):
+        """Take the references of a file loaded from a data directory,
+        call `restored` once all files are in."""
+        with self.lock:
+            for index, (slot, digest) in enumerate(zip(blocks, digests)):
+                self.index[digest] = slot
+                self.digests[slot] = digest
+                self.lengths[slot] = min(self.chunk_size, size - index * self.chunk_size)
+                self.refs[slot] = self.refs.get(slot, 0) + 1
+                self.slots = max(self.slots, slot + 1)
+
+    def restored(self):
+        with self.lock:
+            self.free = [slot for slot in range(self.slots) if slot not in self.refs]
+            heapq.heapify(self.free)
+
+    def sync(self):
+        if self.path is not None:
+            self.pack.flush()
+            os.fsync(self.pack.fileno())
+
+    def count(self, size: int):
+        return -(-size // self.chunk_size)
+
+    def lookup(self, digests: List[bytes]):
+        known: Dict[int, int] = {}
+        with self.lock:
+            for index, digest in enumerate(digests):
+                slot = self.index.get(digest)
+                if slot is not None:
+                    self.refs[slot] += 1
+                    known[index] = slot
+        return known
+
+    def store(
+        self,
+        fd: int,
+        size: int,
+        known: Optional[Dict[int, int]] = None,
+        digests: Optional[List[bytes]] = None,
+    ):
+        """Store the chunks of `fd`, except those already `known`.
+
+        The references in `known` are taken over by the returned list."""
+        known = known or {}
+        blocks, added = [], []
+        try:
+            for index in range(self.count(size)):
+                if index in known:
+                    blocks.append(known[index])
+                    continue
+                offset = index * self.chunk_size
+                data = pread(fd, min(self.chunk_size, size - offset), offset)
+                slot = self.put(data)
+                added.append(slot)
+                blocks.append(slot)
+                assert digests is None or self.digests[slot] == digests[index], FAIL_LEN
+        except BaseException:
+            self.release(added)
+            raise
+        return blocks
+
+    def acquire(self, blocks: List[int]):
+        with self.lock:
+            for slot in blocks:
+                self.refs[slot] += 1
+
+    def release(self, blocks: List[int]):
+        with self.lock:
+            for slot in blocks:
+                self.refs[slot] -= 1
+                if not self.refs[slot]:
+                    del self.index[self.digests.pop(slot)]
+                    del self.lengths[slot], self.refs[slot]
+                    heapq.heappush(self.free, slot)
+
+    def segments(self, blocks: List[int], offset: int, length: int):
+        for slot in blocks:
+            size = self.lengths[slot]
+            if offset >= size:
+                offset -= size
+                continue
+            if length <= 0:
+                break
+            count = min(size - offset, length)
+            yield self.pack, slot * self.chunk_size + offset, count
+            offset, length = 0, length - count
+
+    @staticmethod
+    def root(digests: List[bytes]):
+        return hashlib.sha256(b"".join(digests)).digest()
+
+    def usage(self):
+        with self.lock:
+            stored = sum(self.lengths.values())
+            return {
+                "stored": stored,
+                "disk": os.fstat(self.pack.fileno()).st_size,
+                "chunks": len(self.lengths),
+            }
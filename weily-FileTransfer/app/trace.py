@@ -0,0 +1,161 @@
+import cProfile
+import itertools
+import contextvars
+import tracemalloc
+from .utility import *
+
+
+NO_SPAN = contextlib.nullcontext()
+MALLOC_FRAMES = 16
+MALLOC_TOP = 50
+
+
+class Tracer:
+    """Spans in the Chrome trace-event format, see chrome://tracing or
+    https://ui.perfetto.dev.
+
+    Every request gets its own track, named after its connection and stream,
+    so that its phases nest; spans outside of a request (I/O threads, the
+    client) go to the track of their thread. Timestamps are time.monotonic.
+    Nothing is recorded until `open`."""
+
+    def __init__(self):
+        self.file: Optional[typing.TextIO] = None
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.ids = itertools.count(1)
+        self.conn: contextvars.ContextVar[int] = contextvars.ContextVar("conn", default=0)
+        self.track: contextvars.ContextVar[int] = contextvars.ContextVar("track", default=0)
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def open(self, path: str):
+        self.pid = os.getpid()
+        self.file = open(path, "w")
+        self.file.write("[\n")
+        self.name(0, "process_name", f"FileTransfer {self.pid}")
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            file, self.file = self.file, None
+            file.write(json.dumps({"ph": "M", "name": "trace_end", "pid": self.pid, "tid": 0}))
+            file.write("\n]\n")
+            file.close()
+
+    def emit(self, event: Dict[str, Any]):
+        line = json.dumps(event) + ",\n"
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line)
+
+    def name(self, track: int, kind: str, name: str):
+        self.emit(
+            {"ph": "M", "name": kind, "pid": self.pid, "tid": track, "args": {"name": name}}
+        )
+
+    def connect(self):
+        """Give the connection of the current task an ID, streams inherit it."""
+        if self.enabled:
+            self.conn.set(next(self.ids))
+
+    def request(self, stream: Optional[int] = None):
+        """Start the track of a request in the current task."""
+        if self.enabled:
+            track = next(self.ids)
+            self.track.set(track)
+            where = f"conn {self.conn.get()}" + ("" if stream is None else f" stream {stream}")
+            self.name(track, "thread_name", where)
+
+    def current(self):
+        return self.track.get() or threading.get_ident()
+
+    def complete(self, name: str, start: float, end: float, track: int, **args: Any):
+        self.emit(
+            {
+                "ph": "X",
+                "name": name,
+                "pid": self.pid,
+                "tid": track,
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "args": args,
+            }
+        )
+
+    def span(self, name: str, **args: Any):
+        if self.file is None:
+            return NO_SPAN
+        return self.record(name, args)
+
+    @contextlib.contextmanager
+    def record(self, name: str, args: Dict[str, Any]):
+        track, start = self.current(), time.monotonic()
+        if self.conn.get():
+            args["conn"] = self.conn.get()
+        try:
+            yield args
+        except BaseException as err:
+            args["error"] = str(err) or type(err).__name__
+            raise
+        finally:
+            self.complete(name, start, time.monotonic(), track, **args)
+
+    def wrap(self, func: Callable[..., Any]):
+        """`func` traced on the thread that runs it, tagged with the caller's request."""
+        if self.file is None:
+            return func
+        track, conn = self.track.get(), self.conn.get()
+
+        @wraps(func)
+        def traced(*args: Any, **kw: Any):
+            with self.span(func.__name__, conn=conn, request=track):
+                return func(*args, **kw)
+
+        return traced
+
+
+tracer = Tracer()
+
+
+@contextlib.contextmanager
+def tracing(path: Optional[str] = None):
+    if path is not None:
+        tracer.open(path)
+    try:
+        yield
+    finally:
+        tracer.close()
+
+
+@contextlib.contextmanager
+def profiling(cpu: Optional[str] = None, memory: Optional[str] = None):
+    """Run the body under cProfile and/or tracemalloc, dump the results at the end.
+
+    `cpu` receives pstats data (python -m pstats), `memory` a text report of
+    the largest allocation sites."""
+    profiler = None
+    if memory is not None:
+        tracemalloc.start(MALLOC_FRAMES)
+    if cpu is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cpu)
+        if memory is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats = snapshot.statistics("traceback")
+            with open(memory, "w") as f:
+                f.write(f"current {format_size(current)}, peak {format_size(peak)}\n")
+                for stat in stats[:MALLOC_TOP]:
+                    f.write(f"\n{format_size(stat.size)} in {stat.count} blocks\n")
+                    f.write("\n".join(stat.traceback.format(most_recent_first=True)) + "\n")
@@ -0,0 +1,215 @@
+from .client import Client
+from .trace import tracer
+from .utility import *
+
+
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class Transfer:
+    """One upload (`put`) or download (`get`) of a TransferQueue."""
+
+    def __init__(self, kind: str, name: str, path: str, passwd: str):
+        self.kind = kind
+        self.name = name
+        self.path = path
+        self.passwd = passwd
+        self.state = QUEUED
+        self.result: Optional[str] = None
+        self.done = 0
+        self.size = 0  # 0 until the size is known
+        self.stop = threading.Event()
+        self.cancelled = False
+        self.finished = threading.Event()
+
+    @property
+    def active(self):
+        return self.state not in FINISHED
+
+
+class TransferQueue:
+    """Runs queued transfers on at most `workers` threads sharing one Client.
+
+    Paused transfers keep what they got: a paused download is continued from
+    the end of its output file, a paused upload from the server's ranges.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        workers: Optional[int] = None,
+        on_change: Callable[[Transfer], Any] = lambda transfer: None,
+    ):
+        self.client = client
+        self.workers = WORKERS if workers is None else max(1, workers)
+        self.on_change = on_change
+        self.lock = threading.Condition()
+        self.pending: Deque[Transfer] = collections.deque()
+        self.threads = 0
+        self.idle = 0
+        self.samples: Deque[Tuple[float, int]] = collections.deque()
+        self.closed = False
+
+    def get(self, name: str, passwd: str, output: str, size: int = 0):
+        transfer = Transfer("get", name, output, passwd)
+        transfer.size = size
+        return self.submit(transfer)
+
+    def put(self, filepath: str, passwd: str):
+        transfer = Transfer("put", getFilename(filepath), filepath, passwd)
+        transfer.size = os.path.getsize(filepath)
+        return self.submit(transfer)
+
+    def submit(self, transfer: Transfer):
+        with self.lock:
+            self.pending.append(transfer)
+            # idle threads only leave `idle` once they wake up, so compare
+            # with what is queued rather than asking for one idle thread
+            if len(self.pending) > self.idle and self.threads < self.workers:
+                self.threads += 1
+                threading.Thread(target=self.work, daemon=True).start()
+            self.lock.notify()
+        return transfer
+
+    def pause(self, transfer: Transfer):
+        with self.lock:
+            if transfer.state == QUEUED:
+                self.pending.remove(transfer)
+                self.set_state(transfer, PAUSED, PAUSE)
+            elif transfer.state == RUNNING:
+                transfer.stop.set()
+
+    def resume(self, transfer: Transfer):
+        with self.lock:
+            if transfer.state != PAUSED:
+                return
+            transfer.stop.clear()
+            self.set_state(transfer, QUEUED)
+        self.submit(transfer)
+
+    def cancel(self, transfer: Transfer):
+        with self.lock:
+            transfer.cancelled = True
+            if transfer.state == RUNNING:
+                transfer.stop.set()
+                return
+            if transfer.state == QUEUED:
+                self.pending.remove(transfer)
+            elif transfer.state != PAUSED:
+                return
+        self.discard(transfer)
+        self.finish(transfer, CANCELLED, ABORT)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = list(self.pending), collections.deque()
+            self.lock.notify_all()
+        for transfer in pending:
+            self.finish(transfer, CANCELLED, ABORT)
+
+    def throughput(self):
+        """Bytes per second over the last RATE_WINDOW seconds, all transfers."""
+        with self.lock:
+            self.trim(time.monotonic())
+            return sum(size for _, size in self.samples) / RATE_WINDOW
+
+    def trim(self, now: float):
+        while self.samples and self.samples[0][0] < now - RATE_WINDOW:
+            self.samples.popleft()
+
+    def progress(self, transfer: Transfer, done: int, size: int):
+        now = time.monotonic()
+        with self.lock:
+            self.samples.append((now, done - transfer.done))
+            self.trim(now)
+        transfer.done, transfer.size = done, size
+        self.on_change(transfer)
+        return transfer.stop.is_set()
+
+    def set_state(self, transfer: Transfer, state: str, result: Optional[str] = None):
+        transfer.state, transfer.result = state, result
+        self.on_change(transfer)
+
+    def finish(self, transfer: Transfer, state: str, result: Optional[str]):
+        self.set_state(transfer, state, result)
+        transfer.finished.set()
+
+    def wait(self, transfers: Iterable[Transfer], timeout: Optional[float] = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for transfer in transfers:
+            left = None if deadline is None else max(0, deadline - time.monotonic())
+            if not transfer.finished.wait(left):
+                return False
+        return True
+
+    def work(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+                while not self.pending and not self.closed:
+                    self.lock.wait()
+                self.idle -= 1
+                if self.closed:
+                    self.threads -= 1
+                    return
+                transfer = self.pending.popleft()
+                self.set_state(transfer, RUNNING)
+            try:
+                with tracer.span(transfer.kind, file=transfer.name):
+                    if transfer.kind == "get":
+                        result = self.run_get(transfer)
+                    else:
+                        result = self.run_put(transfer)
+            except (OSError, EOFError, AssertionError) as err:
+                result = str(err) or FAIL_REQ
+            except UnicodeError:
+                result = FAIL_SEND
+            with self.lock:
+                stopped = transfer.stop.is_set()
+                if stopped and not transfer.cancelled:
+                    self.set_state(transfer, PAUSED, PAUSE)
+                    continue
+            if stopped:
+                self.discard(transfer)
+                self.finish(transfer, CANCELLED, ABORT)
+            else:
+                self.finish(transfer, DONE if result == OK.decode() else FAILED, result)
+
+    def discard(self, transfer: Transfer):
+        """Drop what a cancelled transfer left behind."""
+        try:
+            if transfer.kind == "put":
+                self.client.abort_upload(transfer.path)
+            elif transfer.done and os.path.exists(transfer.path):
+                os.remove(transfer.path)
+        except (OSError, AssertionError) as err:
+            stdloggers.err_logger(err)
+
+    def run_put(self, transfer: Transfer):
+        def callback(sent: int, size: int):
+            return self.progress(transfer, sent, size)
+
+        return self.client.insert(
+            transfer.path, transfer.passwd, callback=callback, keep=True
+        )
+
+    def run_get(self, transfer: Transfer):
+        def callback(done: int, size: int):
+            return self.progress(transfer, done, size)
+
+        # resumed after a pause when something already arrived
+        self.client.get(
+            transfer.name,
+            transfer.passwd,
+            transfer.path,
+            resume=transfer.done > 0,
+            callback=callback,
+        )
+        return ABORT if transfer.stop.is_set() else OK.decode()
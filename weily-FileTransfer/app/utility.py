@@ -1,12 +1,16 @@
 import io
+import contextlib
 import os
 import sys
 import time
 import json
+import secrets
+import struct
 import socket
 import asyncio
 import os.path
 import queue
+import collections
 import threading
 import traceback
 import typing
@@ -15,13 +19,40 @@ from typing import *  # type: ignore
 from functools import wraps
 
 
-VERSION = "0.3.0"
+VERSION = "0.4.0"
+LEGACY_VERSION = "0.3.0"
 VERSION_DIFF = "The server and client versions are different."
 SETTING_DIFF = "The communication settings between the server and client are different."
 
 CLI_TIMEOUT = 4
 SER_TIMEOUT = 4
 BUFSIZE = 65536
+ACK_WINDOW = 1 << 22
+
+MUX_MAGIC = b"\0FTM"
+MUX_WINDOW = 1 << 21
+MUX_MAX_FRAME = 1 << 24
+MUX_IDLE = 60
+BODY_REQUESTS = ("insert", "put")  # the others reset a stream that sends DATA
+POOL_SIZE = 4
+STREAMS = 1
+WORKERS = 4
+RATE_WINDOW = 2.0
+PART_MIN = 1 << 23
+UPLOAD_GRACE = 600
+EXPIRE_INTERVAL = 60
+CHUNK_SIZE = 1 << 20
+COMPRESS_BLOCK = 1 << 16
+JOURNAL_MAX = 1024
+CHANGES_MAX = 4096
+METRICS_INTERVAL = 10
+WATCH_RETRY = 5
+IO_WORKERS = 4
+WRITE_BEHIND = 1 << 23
+ENTROPY_SAMPLE = 4096
+ENTROPY_MAX = 7.5
+LOOPS = ("auto", "asyncio", "uvloop")
+SERVER_WORKERS = 1
 
 OK = b"Ok."
 CONT = b"CONT."
@@ -35,7 +66,30 @@ REQ_HEAD_TOO_LONG = "Request header too long."
 FAIL_REQ = "Request failed."
 FAIL_SEND = "Send failed."
 FAIL_LEN = "Length verification failed."
+BAD_RANGE = "Invalid range."
+UPLOAD_NOT_EXIST = "Upload does not exist."
+CONN_CLOSED = "Connection closed."
+ABORT = "Abort."
+PAUSE = "Paused."
 TIMED_OUT = "timed out"
+NO_UVLOOP = "uvloop is not installed."
+NO_WORKERS = "Server workers need Linux (fork and SO_REUSEPORT)."
+WORKERS_DATADIR = "Server workers need a data directory and no dedup."
+
+STATUS = (
+    OK.decode(),
+    CANT_READ,
+    PASSWD_ERR,
+    FILE_EXIST,
+    FILE_NOT_EXIST,
+    REQ_HEAD_TOO_LONG,
+    FAIL_REQ,
+    FAIL_LEN,
+    TIMED_OUT,
+    BAD_RANGE,
+    UPLOAD_NOT_EXIST,
+)
+STATUS_OTHER = 0xFFFF
 
 NO_ITEM = "No item selected."
 TOO_MANY_ITEM = "Too many items selected."
@@ -44,65 +98,181 @@ INFO = "[INFO]"
 WARN = "[WARN]"
 
 UI_BLOCK = 100
+UI_RESORT = 64
+UI_POLL = 0.1
+
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warn": 30, "error": 40}
+LEVEL_NAMES = {value: name for name, value in LOG_LEVELS.items()}
+LOG_BATCH = 256
+LOG_INTERVAL = 1.0
 
 
 class Loggers:
+    """Log records are queued as is and formatted on the writer thread.
+
+    Records below `level` are dropped by the caller. With `as_json` set,
+    each record is written as one JSON object per line.
+    """
+
     def __init__(
         self,
         log_file: typing.TextIO = sys.stdout,
         err_file: typing.TextIO = sys.stderr,
+        *,
+        level: str = "info",
+        as_json: bool = False,
     ):
         self.log_file = log_file
         self.err_file = err_file
+        self.level = LOG_LEVELS[level]
+        self.as_json = as_json
+        self.last: Dict[Any, float] = {}
+        self.stamp: Tuple[int, str] = (-1, "")
+        self.start()
+
+    def start(self):
+        """Start the writer thread, again in a forked child that lost it."""
         self.taskQ = queue.Queue()
-        self.task = threading.Thread(target=self.out_task).start()
+        self.task = threading.Thread(target=self.out_task)
+        self.task.start()
+
+    def set_level(self, level: str):
+        self.level = LOG_LEVELS[level]
 
-    @staticmethod
-    def ftime():
-        return f"{time.strftime('%Y-%m-%dT%H:%M:%S%z')} {time.monotonic():.3f}"
+    def ftime(self, wall: float, mono: float):
+        # strftime is the expensive part, do it once a second
+        if int(wall) != self.stamp[0]:
+            local = time.localtime(wall)
+            self.stamp = (int(wall), time.strftime("%Y-%m-%dT%H:%M:%S%z", local))
+        return f"{self.stamp[1]} {mono:.3f}"
 
     def close(self):
         self.taskQ.put(None)
 
     def out_task(self):
-        while True:
-            tk = self.taskQ.get()
-            if tk is None:
-                break
-            print(*tk[0], file=tk[1])
-        while not self.taskQ.empty():
-            tk = self.taskQ.get_nowait()
-            print(*tk[0], file=tk[1])
+        running = True
+        while running:
+            batch = [self.taskQ.get()]
+            while len(batch) < LOG_BATCH and not self.taskQ.empty():
+                batch.append(self.taskQ.get_nowait())
+            if None in batch:
+                running = False
+                batch = [tk for tk in batch if tk is not None]
+                while not self.taskQ.empty():
+                    tk = self.taskQ.get_nowait()
+                    if tk is not None:
+                        batch.append(tk)
+            self.write(batch)
+
+    def write(self, batch: List[Tuple[Any, ...]]):
+        lines: Dict[int, List[str]] = {}
+        files = {}
+        for record in batch:
+            file = self.err_file if record[0] >= LOG_LEVELS["warn"] else self.log_file
+            files[id(file)] = file
+            lines.setdefault(id(file), []).append(self.format(*record))
+        for key, text in lines.items():
+            try:
+                files[key].write("".join(text))
+                files[key].flush()
+            except (OSError, ValueError):
+                pass
 
-    def err_logger(self, error: BaseException):
-        self.taskQ.put(
-            (
-                (
-                    self.ftime() + "\n",
-                    *traceback.format_exception(
-                        type(error), error, error.__traceback__
-                    ),
-                ),
-                self.err_file,
+    def format(
+        self,
+        level: int,
+        wall: float,
+        mono: float,
+        before: Optional[str],
+        args: Tuple[Any, ...],
+        error: Optional[BaseException],
+    ):
+        trace = ""
+        if error is not None:
+            trace = "".join(
+                traceback.format_exception(type(error), error, error.__traceback__)
             )
-        )
+        if self.as_json:
+            record = {
+                "time": wall,
+                "mono": round(mono, 3),
+                "level": LEVEL_NAMES[level],
+                "msg": " ".join(map(str, args)),
+            }
+            if before is not None:
+                record["tag"] = before
+            if trace:
+                record["traceback"] = trace
+            return json.dumps(record) + "\n"
+        head = self.ftime(wall, mono)
+        if error is not None:
+            return f"{head}\n{trace}"
+        parts = [head, *map(str, args)]
+        if before is not None:
+            parts.insert(0, before)
+        return " ".join(parts) + "\n"
+
+    def put(
+        self,
+        level: int,
+        args: Tuple[Any, ...],
+        before: Optional[str] = None,
+        error: Optional[BaseException] = None,
+    ):
+        if level >= self.level:
+            record = (level, time.time(), time.monotonic(), before, args, error)
+            self.taskQ.put(record)
+
+    def err_logger(self, error: BaseException):
+        self.put(LOG_LEVELS["error"], (), error=error)
 
     def warn_logger(self, *args, before: Optional[str] = None):
-        if before is None:
-            self.taskQ.put(((self.ftime(), *args), self.err_file))
-        else:
-            self.taskQ.put(((before, self.ftime(), *args), self.err_file))
+        self.put(LOG_LEVELS["warn"], args, before)
 
     def log_logger(self, *args, before: Optional[str] = None):
-        if before is None:
-            self.taskQ.put(((self.ftime(), *args), self.log_file))
+        self.put(LOG_LEVELS["info"], args, before)
+
+    def debug_logger(self, *args, before: Optional[str] = None):
+        self.put(LOG_LEVELS["debug"], args, before)
+
+    def progress_logger(self, key: Any, *args, final: bool = False):
+        """Log `args` at most every LOG_INTERVAL seconds for each `key`,
+        e.g. a request; `progress_end(key)` forgets a key that never got
+        to its final line."""
+        if LOG_LEVELS["info"] < self.level:
+            return
+        now = time.monotonic()
+        if final:
+            self.last.pop(key, None)
+        elif now - self.last.get(key, -LOG_INTERVAL) < LOG_INTERVAL:
+            return
         else:
-            self.taskQ.put(((before, self.ftime(), *args), self.log_file))
+            self.last[key] = now
+        self.log_logger(*args)
+
+    def progress_end(self, key: Any):
+        self.last.pop(key, None)
 
 
 stdloggers = Loggers()
 
 
+def set_loop(name: str = "auto"):
+    """Pick the event loop of asyncio.run, "auto" takes uvloop if it is installed."""
+    assert name in LOOPS, CANT_READ
+    if name != "asyncio":
+        try:
+            import uvloop  # type: ignore
+        except ImportError:
+            assert name == "auto", NO_UVLOOP
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+    asyncio.set_event_loop_policy(None)
+    return "asyncio"
+
+
 def try_recv(client: socket.socket, bufsize: int):
     try:
         return client.recv(bufsize)
@@ -122,6 +292,17 @@ def safe_send_head(client: socket.socket, msg: bytes, bufsize: int):
     try_send(client, msg)
 
 
+def recv_exact(client: socket.socket, size: int):
+    data = bytearray(size)
+    view, got = memoryview(data), 0
+    while got < size:
+        n = client.recv_into(view[got:])
+        if not n:
+            raise EOFError(CONN_CLOSED)
+        got += n
+    return data
+
+
 def recvs(client: socket.socket, bufsize: int):
     data = bytearray()
     while True:
@@ -132,6 +313,48 @@ def recvs(client: socket.socket, bufsize: int):
     return data
 
 
+_seek_lock = threading.Lock()
+
+
+def pread(fd: int, size: int, offset: int):
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def pwrite(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, view, offset)
+        else:
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+
+def pread_chunks(fd: int, offset: int, count: int, bufsize: int):
+    end = offset + count
+    while offset < end:
+        data = pread(fd, min(bufsize, end - offset), offset)
+        if not data:
+            break
+        offset += len(data)
+        yield data
+
+
+def status_code(msg: str):
+    return STATUS.index(msg) if msg in STATUS else STATUS_OTHER
+
+
+def status_text(code: int, msg: str = ""):
+    return msg or (STATUS[code] if code < len(STATUS) else FAIL_REQ)
+
+
 def getFilename(path: str):
     return path.replace("\\", "/").split("/")[-1]
 
@@ -149,6 +372,11 @@ def format_size(size_bytes: Union[int, float]):
     return f"{size_bytes:.2f} {units[index]}"
 
 
+def format_time(seconds: float):
+    seconds = max(0, int(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
 def withThread(function: Callable[..., Any]):
     @wraps(function)
     def wrapper(*args, **kwargs):
@@ -0,0 +1,155 @@
+import ctypes
+import signal
+import selectors
+from .server import Server
+from .utility import *
+
+
+SO_ATTACH_REUSEPORT_CBPF = 51
+SKF_NET_OFF = -0x100000
+HUB_POLL = 1.0
+STOP_GRACE = 1.0
+
+
+def affinity(count: int):
+    """Classic BPF program that picks the socket of a new connection from
+    its source address, so all connections of a client reach one worker
+    and its uploads, deltas and watches stay in one process."""
+    program = (
+        (0x20, 0, 0, (SKF_NET_OFF + 12) & 0xFFFFFFFF),  # A = source address
+        (0x94, 0, 0, count),  # A %= count
+        (0x16, 0, 0, 0),  # return A
+    )
+    return b"".join(struct.pack("HBBI", *ins) for ins in program)
+
+
+def listen(addr: Tuple[str, int], count: int):
+    """One SO_REUSEPORT socket per worker, in the order the filter picks them."""
+    assert sys.platform.startswith("linux") and hasattr(os, "fork"), NO_WORKERS
+    socks: List[socket.socket] = []
+    try:
+        for _ in range(count):
+            socks.append(socket.create_server(addr, reuse_port=True))
+        program = affinity(count)
+        code = ctypes.create_string_buffer(program)
+        prog = struct.pack("HP", len(program) // 8, ctypes.addressof(code))
+        socks[0].setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, prog)
+    except BaseException:
+        for sock in socks:
+            sock.close()
+        raise
+    return socks
+
+
+def run_worker(
+    server: Server,
+    worker: int,
+    sock: socket.socket,
+    hub: socket.socket,
+    setup: Callable[[int], ContextManager[Any]],
+):
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    stdloggers.start()  # the writer thread stayed in the parent
+    code = 0
+    try:
+        server.share(worker)
+        with setup(worker):
+            asyncio.run(server.start(sock, hub))
+    except KeyboardInterrupt:
+        pass
+    except BaseException as err:
+        stdloggers.err_logger(err)
+        code = 1
+    finally:
+        stdloggers.close()
+        stdloggers.task.join()
+        os._exit(code)
+
+
+def serve(
+    server: Server,
+    count: int,
+    setup: Callable[[int], ContextManager[Any]] = lambda worker: contextlib.nullcontext(),
+):
+    """Run `server` in `count` forked processes that share its port.
+
+    The parent only relays the inserts and erases of each worker to the
+    others, which keeps every file table in step with the shared data
+    directory, and restarts workers that die. `setup(worker)` is entered
+    around each worker, e.g. to trace or profile it."""
+    assert server.manifest is not None and server.store is None, WORKERS_DATADIR
+    socks = listen(server.addr, count)
+    selector = selectors.DefaultSelector()
+    hubs: Dict[int, socket.socket] = {}
+    buffers: Dict[socket.socket, bytearray] = {}
+    pids: Dict[int, int] = {}
+
+    def spawn(worker: int):
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            selector.close()
+            for sock in (parent, *hubs.values(), *socks):
+                if sock is not socks[worker]:
+                    sock.close()
+            run_worker(server, worker, socks[worker], child, setup)
+        child.close()
+        hubs[worker] = parent
+        buffers[parent] = bytearray()
+        selector.register(parent, selectors.EVENT_READ, worker)
+        pids[pid] = worker
+
+    def reap(timeout: float = 0):
+        deadline = time.monotonic() + timeout
+        while pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                yield pids.pop(pid), status
+            elif time.monotonic() < deadline:
+                time.sleep(0.05)
+            else:
+                break
+
+    def relay(hub: socket.socket, worker: int):
+        data = hub.recv(BUFSIZE)
+        if not data:
+            selector.unregister(hub)
+            hub.close()
+            del buffers[hub]
+            if hubs.get(worker) is hub:
+                del hubs[worker]
+            return
+        buffer = buffers[hub]
+        buffer += data
+        end = buffer.rfind(b"\n") + 1
+        if not end:
+            return
+        lines = bytes(buffer[:end])
+        del buffer[:end]
+        for other, peer in hubs.items():
+            if other != worker:
+                with contextlib.suppress(OSError):
+                    peer.sendall(lines)
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for worker in range(count):
+            spawn(worker)
+        stdloggers.log_logger("Start:", server.addr, server.ver_info, f"{count} workers")
+        while True:
+            for key, _ in selector.select(HUB_POLL):
+                relay(key.fileobj, key.data)  # type: ignore
+            for worker, status in list(reap()):
+                stdloggers.warn_logger(f"Worker {worker} exited ({status}), restarting")
+                spawn(worker)
+    finally:
+        # Ctrl-C reaches the workers as well, anything else is passed on
+        for _ in reap(STOP_GRACE):
+            pass
+        for pid in pids:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGINT)
+        for _ in reap(float("inf")):
+            pass
+        for sock in (*buffers, *socks):
+            sock.close()
@@ -3,6 +3,11 @@ import tomlkit
 
 from typing import *  # type: ignore
 
+try:
+    from app.utility import LOG_LEVELS, LOOPS
+except ImportError:
+    from .app.utility import LOG_LEVELS, LOOPS
+
 
 UA_PAR = "Unable to parse configuration file (key: {key})"
 MODE = "mode"
@@ -28,12 +33,52 @@ def CheckBigInt(start: int, name: Optional[str] = None):
     return checker
 
 
+def CheckBool(name: Optional[str] = None):
+    """Only true and false, `bool("false")` would be True."""
+
+    def checker(val: Any):
+        if isinstance(val, bool):
+            return val
+        if isinstance(val, str) and val.lower() in ("true", "false"):
+            return val.lower() == "true"
+        raise ValueError
+
+    if name is not None:
+        checker.__name__ = name
+    return checker
+
+
+def CheckChoice(choices: Iterable[str], name: Optional[str] = None):
+    choices = tuple(choices)
+
+    def checker(val: Any):
+        if val not in choices:
+            raise ValueError
+        return str(val)
+
+    if name is not None:
+        checker.__name__ = name
+    return checker
+
+
 SETTING_TYPE = {
     "host": str,
     "post": int,
     "buf": CheckBigInt(1024),
     "timeout": float,
     "superpasswd": str,
+    "streams": CheckBigInt(1),
+    "workers": CheckBigInt(1),
+    "grace": float,
+    "dedup": CheckBool(),
+    "compress": str,
+    "datadir": str,
+    "journal": CheckBool(),
+    "metrics": str,
+    "loglevel": CheckChoice(LOG_LEVELS),
+    "logjson": CheckBool(),
+    "processes": CheckBigInt(1),
+    "loop": CheckChoice(LOOPS),
 }
 
 
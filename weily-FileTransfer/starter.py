@@ -1,8 +1,9 @@
 import sys
 import argparse
+import contextlib
 import tomlkit.exceptions
 
-from typing import Optional
+from typing import Dict, Optional
 
 try:
     from settings import MODE_CHOICES, SERVER, CheckBigInt, get_setting, Settings
@@ -10,11 +11,15 @@ except ImportError:
     from .settings import MODE_CHOICES, SERVER, CheckBigInt, get_setting, Settings
 
 try:
-    from app import Server, UI, asyncio, stdloggers
+    from app import CODECS, LOG_LEVELS, LOOPS, SERVER_WORKERS, Server, UI
+    from app import asyncio, profiling, serve, set_loop, stdloggers, tracing
 except ImportError:
-    from .app import Server, UI, asyncio, stdloggers
+    from .app import CODECS, LOG_LEVELS, LOOPS, SERVER_WORKERS, Server, UI
+    from .app import asyncio, profiling, serve, set_loop, stdloggers, tracing
 
 TOML_FILE = "filetransfer.toml"
+# diagnostics of one run, never saved to the TOML file
+DEBUG_OPTIONS = ("trace", "profile", "memprofile")
 
 
 def get_path():
@@ -25,6 +30,15 @@ def get_toml_file():
     return (get_path() or ".") + "/" + TOML_FILE
 
 
+def add_switch(parser: argparse.ArgumentParser, name: str, help: str):
+    """--name and --no-name, so that a value saved to the TOML file can be turned off."""
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(f"--{name}", action="store_const", const=True, help=help)
+    group.add_argument(
+        f"--no-{name}", dest=name, action="store_const", const=False, help=f"turn off --{name}"
+    )
+
+
 def build_parser(mode: Optional[str] = None):
     if mode is None:
         parser = argparse.ArgumentParser(description="Launch the File Transfer.")
@@ -48,14 +62,102 @@ def build_parser(mode: Optional[str] = None):
         type=CheckBigInt(1024, "size"),
         help="set buffer size, which must be greater than or equal to 1024",
     )
+    parser.add_argument(
+        "-s",
+        "--streams",
+        type=CheckBigInt(1, "count"),
+        help="set the number of parallel connections used for one large file",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=CheckBigInt(1, "count"),
+        help="set how many files the client uploads or downloads at once",
+    )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        choices=list(CODECS),
+        help="compress transfers with the given codec when the server supports it",
+    )
+    parser.add_argument(
+        "--grace",
+        type=float,
+        help="set how long in seconds an interrupted upload is kept for resuming, only effective when starting in server mode",
+    )
+    add_switch(
+        parser,
+        "dedup",
+        "store identical file chunks only once, only effective when starting in server mode",
+    )
+    parser.add_argument(
+        "-d",
+        "--datadir",
+        help="keep shared files in this directory across restarts, only effective when starting in server mode",
+    )
+    add_switch(
+        parser,
+        "journal",
+        "log inserts and erases to a write-ahead journal in the data directory",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="export Prometheus metrics to this file, or on this local port, only effective when starting in server mode",
+    )
+    parser.add_argument(
+        "--processes",
+        type=CheckBigInt(1, "count"),
+        help="serve from this many processes sharing the port, which needs Linux and a data directory, only effective when starting in server mode",
+    )
+    parser.add_argument(
+        "--loop",
+        choices=LOOPS,
+        help="set the event loop, auto uses uvloop when it is installed",
+    )
+    parser.add_argument(
+        "--loglevel",
+        choices=list(LOG_LEVELS),
+        help="only log messages of this level or above",
+    )
+    add_switch(
+        parser,
+        "logjson",
+        "write the log as JSON lines",
+    )
+    parser.add_argument(
+        "--trace",
+        help="record the phases of every request to this file as Chrome trace-event JSON",
+    )
+    parser.add_argument(
+        "--profile",
+        help="run the server under cProfile and dump the stats to this file on shutdown",
+    )
+    parser.add_argument(
+        "--memprofile",
+        help="trace the server's allocations with tracemalloc and write the top ones to this file on shutdown",
+    )
     return parser
 
 
+def diagnostics(debug: Dict[str, Optional[str]], suffix: str = ""):
+    def path(key: str):
+        return None if debug[key] is None else debug[key] + suffix
+
+    stack = contextlib.ExitStack()
+    stack.enter_context(tracing(path("trace")))
+    stack.enter_context(profiling(path("profile"), path("memprofile")))
+    return stack
+
+
 def start(parser: argparse.ArgumentParser, mode: Optional[str] = None):
     try:
-        args = Settings(get_setting(parser.parse_args(), get_toml_file(), mode=mode))
+        argv = parser.parse_args()
+        debug = {key: vars(argv).pop(key) for key in DEBUG_OPTIONS}
+        args = Settings(get_setting(argv, get_toml_file(), mode=mode))
         if mode is None:
             mode = args.mode
+        stdloggers.set_level(args.loglevel or "info")
+        stdloggers.as_json = bool(args.logjson)
         if mode == SERVER:
             app = Server(
                 super_passwd=args.superpasswd,
@@ -63,16 +165,31 @@ def start(parser: argparse.ArgumentParser, mode: Optional[str] = None):
                 post=args.post,
                 client_timeout=args.timeout,
                 bufsize=args.buf,
+                grace=args.grace,
+                dedup=bool(args.dedup),
+                datadir=args.datadir,
+                journal=bool(args.journal),
+                metrics=args.metrics,
             )
-            asyncio.run(app.start())
+            set_loop(args.loop or "auto")
+            processes = args.processes or SERVER_WORKERS
+            if processes > 1:
+                serve(app, processes, lambda worker: diagnostics(debug, f".{worker}"))
+            else:
+                with diagnostics(debug):
+                    asyncio.run(app.start())
         else:
             app = UI(
                 host=args.host,
                 post=args.post,
                 client_timeout=args.timeout,
                 bufsize=args.buf,
+                streams=args.streams,
+                compress=args.compress,
+                workers=args.workers,
             )
-            app.mainloop()
+            with tracing(debug["trace"]):
+                app.mainloop()
     except (AssertionError, tomlkit.exceptions.TOMLKitError) as err:
         stdloggers.warn_logger("TOML Error:", str(err))
     except OSError as err: